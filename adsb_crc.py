@@ -0,0 +1,180 @@
+# Mode S parity: table-driven CRC-24 over packed message bytes, error
+# correction with syndrome tables and address/parity (AP) recovery
+#
+# The "syndrome" of a message is the remainder of the whole message,
+# parity field included, as returned by pms.crc: 0 for a correct DF17, the
+# interrogator code (< 0x80) for DF11 and the ICAO address for the AP replies
+# DF4/5/20/21. Flipping message bit j changes the syndrome by the syndrome of
+# a message with only bit j set, so single and double bit errors can be
+# found by looking the syndrome up in a table.
+
+import functools
+import numpy as np
+
+POLY = 0xFFF409
+
+# downlink formats whose parity field is overlaid with the address
+AP_DFS = [4, 5, 20, 21]
+
+
+def _make_table():
+    table = np.zeros(256, dtype=np.uint32)
+    for b in range(256):
+        crc = b << 16
+        for _ in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= POLY
+        table[b] = crc & 0xFFFFFF
+    return table
+
+
+crc_table = _make_table()
+
+
+# Returns the syndromes of the messages in packed, an (n, >= nbits/8) uint8
+# array with one message per row, all nbits (56 or 112) long
+def crc24(packed, nbits=112):
+    packed = np.asarray(packed, dtype=np.uint8)
+    nbytes = nbits // 8
+    crc = np.zeros(len(packed), dtype=np.uint32)
+    for k in range(nbytes - 3):
+        crc = ((crc << 8) & 0xFFFFFF) ^ crc_table[(crc >> 16) ^ packed[:, k]]
+    parity = ((packed[:, nbytes - 3].astype(np.uint32) << 16)
+              | (packed[:, nbytes - 2].astype(np.uint32) << 8)
+              | packed[:, nbytes - 1])
+    return crc ^ parity
+
+
+# Returns (syndromes, bits): the sorted syndromes of every error of up to
+# max_errors bits in an nbits message, leaving the 5 DF bits alone, and the
+# bit positions of each (-1 for unused). Syndromes shared by two errors are
+# left out.
+@functools.lru_cache(maxsize=None)
+def syndrome_table(nbits, max_errors=1):
+    nbytes = nbits // 8
+    single = np.zeros((nbits, nbytes), dtype=np.uint8)
+    single[np.arange(nbits), np.arange(nbits) // 8] = 0x80 >> (np.arange(nbits) % 8)
+    s1 = crc24(single, nbits)
+
+    syndromes = [s1[5:]]
+    bits = [np.stack((np.arange(5, nbits), np.full(nbits - 5, -1)), axis=1)]
+    if max_errors >= 2:
+        i, j = np.triu_indices(nbits, 1)
+        keep = i >= 5
+        syndromes.append(s1[i[keep]] ^ s1[j[keep]])
+        bits.append(np.stack((i[keep], j[keep]), axis=1))
+    syndromes = np.concatenate(syndromes)
+    bits = np.concatenate(bits)
+
+    order = np.argsort(syndromes, kind='stable')
+    syndromes, bits = syndromes[order], bits[order]
+    unique = np.ones(len(syndromes), dtype=bool)
+    same = syndromes[1:] == syndromes[:-1]
+    unique[1:] &= ~same
+    unique[:-1] &= ~same
+    return syndromes[unique], bits[unique]
+
+
+# Corrects the messages in packed (a copy is returned) whose syndromes are
+# in the table, returns (fixed, nerrors) with nerrors the number of bits
+# flipped, 0 for a zero syndrome and -1 if the message can't be fixed
+def correct(packed, syndromes, nbits=112, max_errors=1):
+    fixed = np.array(packed, dtype=np.uint8)
+    syndromes = np.asarray(syndromes, dtype=np.uint32)
+    nerrors = np.where(syndromes == 0, 0, -1)
+
+    table, bits = syndrome_table(nbits, max_errors)
+    if len(fixed) == 0 or len(table) == 0:
+        return fixed, nerrors
+    k = np.minimum(np.searchsorted(table, syndromes), len(table) - 1)
+    found = (table[k] == syndromes) & (syndromes != 0)
+    rows = np.flatnonzero(found)
+    for col in range(bits.shape[1]):
+        b = bits[k[rows], col]
+        ok = b >= 0
+        fixed[rows[ok], b[ok] // 8] ^= (0x80 >> (b[ok] % 8)).astype(np.uint8)
+    nerrors[rows] = (bits[k[rows]] >= 0).sum(axis=1)
+    return fixed, nerrors
+
+
+# Packs hex messages into an (n, 14) uint8 array, left aligned, together with
+# their lengths in bits (0 for messages that are not 56 or 112 bits)
+def hex2packed(msgs):
+    packed = np.zeros((len(msgs), 14), dtype=np.uint8)
+    nbits = np.zeros(len(msgs), dtype=np.intp)
+    for k, msg in enumerate(msgs):
+        if msg is not None and len(msg) in (14, 28):
+            packed[k, :len(msg) // 2] = np.frombuffer(bytes.fromhex(msg), dtype=np.uint8)
+            nbits[k] = 4 * len(msg)
+    return packed, nbits
+
+
+# Checks a batch of hex messages (None for no message) and returns a
+# list of (msg, addr, df) where msg is the message, corrected if needed, or None
+# if it fails its parity check, addr the ICAO address (from the address
+# field for DF11/17, from the parity for DF4/5/20/21) and df the downlink
+# format in the first 5 bits, also for the formats not checked (None for no
+# message). DF11 and DF17 are fixed if they have up to max_errors bit
+# errors; AP replies can only be checked against addresses already seen,
+# see IcaoCache.
+def check_frames(msgs, max_errors=1):
+    packed, nbits = hex2packed(msgs)
+    dfs = packed[:, 0] >> 3
+    results = [(None, None, None if m is None else d) for m, d in zip(msgs, dfs.tolist())]
+    for n, df_ok in [(56, [4, 5, 11]), (112, [17, 20, 21])]:
+        rows = np.flatnonzero((nbits == n) & np.isin(dfs, df_ok))
+        if len(rows) == 0:
+            continue
+        syndromes = crc24(packed[rows], n)
+        df = dfs[rows]
+
+        # DF11 parity carries the interrogator code in its 7 low bits
+        syndromes = np.where((df == 11) & (syndromes < 0x80), 0, syndromes)
+        fixed, nerrors = correct(packed[rows], syndromes, n, max_errors)
+        fix = np.isin(df, [11, 17])
+        addr = np.where(fix, (fixed[:, 1].astype(np.uint32) << 16)
+                        | (fixed[:, 2].astype(np.uint32) << 8) | fixed[:, 3], syndromes)
+
+        for r, f, e, a, d, x in zip(rows.tolist(), fixed, nerrors.tolist(), addr.tolist(),
+                                    df.tolist(), fix.tolist()):
+            if x and e < 0:
+                results[r] = (None, None, d)
+            elif x and e > 0:
+                results[r] = (f[:n // 8].tobytes().hex().upper(), a, d)
+            else:
+                results[r] = (msgs[r], a, d)
+    return results
+
+
+class IcaoCache(object):
+    """addresses seen in parity-checked DF11/DF17 squitters, each kept for
+    ttl seconds after it was last seen. Times are whatever clock the caller
+    uses (adsb_read uses the sample time so replays behave like live
+    captures)."""
+
+    def __init__(self, ttl=60.0):
+        super(IcaoCache, self).__init__()
+        self.ttl = ttl
+        self.seen = {}
+        self.last_sweep = None
+
+    def __len__(self):
+        return len(self.seen)
+
+    def add(self, addr, t):
+        self.seen[addr] = t
+        if self.last_sweep is None:
+            self.last_sweep = t
+        elif t - self.last_sweep >= self.ttl:
+            self.expire(t)
+
+    # True if addr was seen within ttl seconds of t
+    def has(self, addr, t):
+        seen = self.seen.get(addr)
+        return seen is not None and t - seen <= self.ttl
+
+    # forget the addresses not seen within ttl seconds of t
+    def expire(self, t):
+        self.seen = {a: s for a, s in self.seen.items() if t - s <= self.ttl}
+        self.last_sweep = t
@@ -0,0 +1,386 @@
+# numpy building blocks shared by the ADS-B readers
+
+import functools
+import math
+import numpy as np
+import scipy.signal as sig
+
+pbits = 8
+fbits = 112
+preamble = [1, 0, 1, 0, 0, 0, 0, 1, 0, 1, 0, 0, 0, 0, 0, 0]
+th_amp_diff = 0.8   # signal amplitude threshold difference between 0 and 1 bit
+magnitudes = ['abs', 'power', 'lut']
+
+
+# Returns a np.array with each element of _r replicated times times
+def replicate(a, c):
+    return np.repeat(np.asarray(a), c)
+
+
+# generates the code for a message: the preamble and the Manchester coded
+# bits (1 -> 10, 0 -> 01) of the hex message, each chip repeated osr times.
+# Squitters repeat a lot so the (read-only) waveforms are cached.
+@functools.lru_cache(maxsize=4096)
+def msg2bin(msg, osr):
+    pad = len(msg) % 2
+    bits = np.unpackbits(np.frombuffer(bytes.fromhex('0' * pad + msg), dtype=np.uint8))[4 * pad:]
+    chips = np.stack((bits, 1 - bits), axis=1).ravel()
+    gold = np.repeat(np.concatenate((np.array(preamble, dtype=np.int8), chips.astype(np.int8))), osr)
+    gold.flags.writeable = False
+    return gold
+
+
+# Writes the magnitude of the complex samples cdata into out (float32): the
+# amplitude |x| or, with power, |x|^2 = I^2 + Q^2 without the square root
+def magnitude(cdata, out, power=False):
+    if not power:
+        return np.absolute(cdata, out=out)
+    sq = np.square(cdata.view(np.float32))
+    return np.add(sq[0::2], sq[1::2], out=out)
+
+
+# Amplitudes of all unsigned 8 bit IQ pairs, indexed by the pair read as a
+# little-endian uint16 (I in the low byte), the same values np.absolute
+# gives for the samples iq_to_complex makes of them
+@functools.lru_cache(maxsize=None)
+def uint8_amp_lut():
+    return np.absolute(iq_to_complex(np.arange(65536, dtype='<u2').view(np.uint8)))
+
+
+# Returns the indices i of every candidate preamble in signal, i.e. where
+# signal[i] >= min_amp and abs(signal[i + k] - pattern[k]) <= th for every
+# k in the (replicated) pattern. Each run of equal pattern values is checked
+# with a sliding window sum over the per-sample match mask so the whole
+# buffer is scanned with a handful of array operations. With power the
+# signal (and min_amp) are squared amplitudes and the bounds are squared to
+# match.
+def find_preambles(signal, pattern, min_amp, th=th_amp_diff, power=False):
+    signal = np.asarray(signal)
+    pattern = np.asarray(pattern)
+    plen = len(pattern)
+    n = len(signal) - plen + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.intp)
+
+    cand = signal[:n] >= min_amp
+
+    # start and end of each run of equal values in the pattern
+    edges = np.flatnonzero(np.diff(pattern)) + 1
+    starts = np.concatenate(([0], edges))
+    ends = np.concatenate((edges, [plen]))
+
+    for level in np.unique(pattern):
+        if power:
+            match = (signal >= max(level - th, 0) ** 2) & (signal <= (level + th) ** 2)
+        else:
+            match = np.abs(signal - level) <= th
+        csum = np.zeros(len(signal) + 1, dtype=np.int32)
+        np.cumsum(match, out=csum[1:])
+        for s, e in zip(starts, ends):
+            if pattern[s] == level:
+                cand &= (csum[e:e + n] - csum[s:s + n]) == (e - s)
+
+    return np.flatnonzero(cand)
+
+
+# Demodulates the PPM frames whose preambles start at the indices in starts
+# with the same rules as the per-bit loop: each bit is the larger of its two
+# chips and decoding stops at the first bit where both chips are below 20% of
+# the frame maximum (or where the signal runs out). The (n_frames, 113, 2*osr)
+# pulse windows are gathered with one fancy index per batch and all decisions
+# are made as array operations. Returns (packed, nbits, stop) where packed
+# holds the bits of each frame packed into bytes (MSB first), nbits the number
+# of valid bits and stop the bit index at which decoding stopped. With power
+# signal holds squared amplitudes, so the quiet level is 4% of the maximum.
+def demod_frames(signal, starts, osr, batch=2048, power=False):
+    signal = np.asarray(signal)
+    starts = np.asarray(starts, dtype=np.intp)
+    nslots = fbits + 1
+    packed = np.zeros((len(starts), (nslots + 7) // 8), dtype=np.uint8)
+    nbits = np.zeros(len(starts), dtype=np.intp)
+    stop = np.zeros(len(starts), dtype=np.intp)
+    for lo in range(0, len(starts), batch):
+        hi = lo + batch
+        packed[lo:hi], nbits[lo:hi], stop[lo:hi] = _demod_batch(signal, starts[lo:hi], osr,
+                                                                0.2 ** 2 if power else 0.2)
+    return packed, nbits, stop
+
+
+def _demod_batch(signal, starts, osr, quiet_level=0.2):
+    nframes = len(starts)
+    nslots = fbits + 1
+    bit_len = 2 * osr
+    siglen = len(signal)
+
+    frame_start = starts + pbits * bit_len
+    idx = frame_start[:, None] + np.arange(nslots * bit_len)
+    valid = idx < siglen
+    pulses = signal[np.minimum(idx, siglen - 1)]
+    pulses = np.where(valid, pulses, -np.inf).reshape(nframes, nslots, bit_len)
+
+    # only whole bits can be decided
+    avail = np.clip((siglen - frame_start) // bit_len, 0, nslots)
+
+    threshold = pulses.max(axis=(1, 2)) * quiet_level
+    p0 = pulses[:, :, 0]
+    p1 = pulses[:, :, osr]
+    quiet = (p0 < threshold[:, None]) & (p1 < threshold[:, None])
+    undecided = ~((p0 >= p1) | (p0 < p1))      # only possible with NaNs
+    stop_mask = quiet | undecided | (np.arange(nslots) >= avail[:, None])
+
+    stopped = stop_mask.any(axis=1)
+    first = np.argmax(stop_mask, axis=1)
+    stop = np.where(stopped, first, nslots - 1)
+    nbits = np.where(stopped, first, nslots)
+    nbits[stopped & undecided[np.arange(nframes), first]] = 0
+
+    bits = (p0 >= p1) & (np.arange(nslots) < nbits[:, None])
+    return np.packbits(bits, axis=1), nbits, stop
+
+
+# Returns the hex string of each demodulated frame, matching pms.bin2hex of
+# its bit string (so leading zero nibbles are dropped), or None for frames
+# with no bits
+def frames2hex(packed, nbits):
+    msgs = []
+    for row, n in zip(packed, nbits.tolist()):
+        if n == 0:
+            msgs.append(None)
+            continue
+        nbytes = (n + 7) // 8
+        value = int.from_bytes(row[:nbytes].tobytes(), 'big') >> (8 * nbytes - n)
+        msgs.append("{0:X}".format(value))
+    return msgs
+
+
+# Converts raw unsigned 8 bit IQ pairs to complex64 samples in [-1, 1),
+# writing straight into out (allocated if None) so no temporary arrays are
+# created. Gives the same values as (float(x) - (127+127j)) / 128.
+def iq_to_complex(raw, out=None):
+    n = len(raw) // 2
+    if out is None:
+        out = np.empty(n, dtype=np.complex64)
+    out = out[:n]
+    f = out.view(np.float32)
+    np.subtract(raw[:2 * n], np.float32(127), out=f)
+    np.multiply(f, np.float32(1 / 128), out=f)
+    return out
+
+
+# Preallocated store for the amplitude (float32) and iq (complex64) samples
+# waiting to be processed. New blocks are written after the unprocessed tail,
+# which stays in place between reads and is only moved back to the start of
+# the arrays when they run out of room, so the detector always gets
+# contiguous numpy views rather than copies. pos is the absolute index (in
+# samples since the start of the input) of the first unprocessed sample.
+# With power amp holds squared amplitudes.
+class SampleBuffer(object):
+    def __init__(self, capacity, power=False):
+        super(SampleBuffer, self).__init__()
+        self.power = power
+        self.amp = np.zeros(capacity, dtype=np.float32)
+        self.iq = np.zeros(capacity, dtype=np.complex64)
+        self.reset()
+
+    def __len__(self):
+        return self.end - self.start
+
+    # absolute index one past the last sample
+    @property
+    def total(self):
+        return self.pos + len(self)
+
+    # empty the buffer, the next sample appended has absolute index pos
+    def reset(self, pos=0):
+        self.start = 0
+        self.end = 0
+        self.pos = pos
+
+    # amplitude of the unprocessed samples (a view)
+    def signal(self):
+        return self.amp[self.start:self.end]
+
+    # iq values of the unprocessed samples (a view)
+    def ciq(self):
+        return self.iq[self.start:self.end]
+
+    # append a block of complex samples and their amplitudes, worked out
+    # here unless given in amp
+    def append(self, cdata, amp=None):
+        n = len(cdata)
+        if self.end + n > len(self.iq):
+            self._make_room(n)
+        iq = self.iq[self.end:self.end + n]
+        iq[:] = cdata
+        if amp is None:
+            magnitude(iq, self.amp[self.end:self.end + n], self.power)
+        else:
+            self.amp[self.end:self.end + n] = amp
+        self.end += n
+
+    # drop the first n unprocessed samples
+    def consume(self, n):
+        n = min(n, len(self))
+        self.start += n
+        self.pos += n
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def _make_room(self, n):
+        tail = len(self)
+        if tail + n > len(self.iq):
+            capacity = max(2 * len(self.iq), tail + n)
+            amp = np.zeros(capacity, dtype=np.float32)
+            iq = np.zeros(capacity, dtype=np.complex64)
+        else:
+            amp, iq = self.amp, self.iq
+        amp[:tail] = self.amp[self.start:self.end]
+        iq[:tail] = self.iq[self.start:self.end]
+        self.amp, self.iq = amp, iq
+        self.start, self.end = 0, tail
+
+
+# Streaming noise floor estimate. measure() takes each new block of
+# amplitude samples, carrying partial windows over from the previous block,
+# and returns the lowest mean of the 100us (window samples) windows completed
+# in it; windows are aligned to absolute sample index 0 so any reader of the
+# same samples sees the same windows. apply() moves the floor straight down
+# to a lower measurement and lets it recover towards a higher one with a time
+# constant of recovery seconds, so it follows gain and antenna changes.
+class NoiseTracker(object):
+    def __init__(self, window, sample_rate, floor=0.025, recovery=10.0, pos=0):
+        super(NoiseTracker, self).__init__()
+        self.window = window
+        self.sample_rate = sample_rate
+        self.floor = floor
+        self.recovery = recovery
+        self.skip = -pos % window           # samples to the first window boundary
+        self.carry_sum = 0.0
+        self.carry_n = 0
+
+    def measure(self, signal):
+        if self.skip:
+            k = min(self.skip, len(signal))
+            signal = signal[k:]
+            self.skip -= k
+
+        w = self.window
+        need = w - self.carry_n
+        if len(signal) < need:
+            self.carry_sum += signal.sum(dtype=np.float64)
+            self.carry_n += len(signal)
+            return None
+
+        first = (self.carry_sum + signal[:need].sum(dtype=np.float64)) / w
+        rest = signal[need:]
+        m = len(rest) // w
+        noise = first
+        if m > 0:
+            noise = min(noise, rest[:m * w].reshape(-1, w).mean(axis=1, dtype=np.float64).min())
+        self.carry_sum = rest[m * w:].sum(dtype=np.float64)
+        self.carry_n = len(rest) - m * w
+        return noise
+
+    def apply(self, noise, nsamples):
+        if noise is None:
+            return self.floor
+        if noise < self.floor or self.recovery <= 0:
+            self.floor = noise
+        else:
+            self.floor += (noise - self.floor) * -np.expm1(-nsamples / self.sample_rate / self.recovery)
+        return self.floor
+
+    def update(self, signal):
+        return self.apply(self.measure(signal), len(signal))
+
+
+# Streaming rational resampler by up/down. The low-pass FIR is designed once
+# and applied in a single polyphase pass (upfirdn) per block, carrying the
+# last input samples over so a stream split into blocks gives the same
+# samples as one long block, delayed by nothing: the filter delay is taken
+# off the start of the output. Output sample m is at input time m*down/up
+# whatever the blocking, and pos (input index of the first sample) lets a
+# resampler start mid-stream. Plain upsampling keeps the sample-and-hold of
+# replicate (the -u test mode), which needs no filter or state.
+class Resampler(object):
+    def __init__(self, up=1, down=1, pos=0, half_len=10):
+        super(Resampler, self).__init__()
+        g = math.gcd(up, down)
+        self.up = up // g
+        self.down = down // g
+        self.pos = pos
+        if self.down == 1:
+            self.h = None
+            self.delay = 0
+            return
+        half = half_len * max(self.up, self.down)
+        self.h = (sig.firwin(2 * half + 1, 1.0 / max(self.up, self.down), window=('kaiser', 5.0))
+                  * self.up).astype(np.float32)
+        self.delay = half // self.down
+        # input samples kept for the filter, plus slack for the phase
+        self.nhist = -(-(len(self.h) - 1) // self.up) + self.down
+        self.hist = np.zeros(self.nhist, dtype=np.complex64)
+
+    # index in the output of the first sample resampled from input index pos
+    def out_index(self, pos):
+        return max(-(-pos * self.up // self.down) - self.delay, 0)
+
+    def __call__(self, x):
+        a = self.pos
+        b = a + len(x)
+        self.pos = b
+        if self.h is None:
+            return replicate(x, self.up) if self.up > 1 else x
+
+        # start the filter at an input index whose upsampled position is a
+        # multiple of down, so upfirdn's outputs fall on the output grid
+        g0 = a - (self.nhist - self.down)
+        while (g0 * self.up) % self.down:
+            g0 -= 1
+        ext = np.concatenate((self.hist[len(self.hist) - (a - g0):], x))
+        y = sig.upfirdn(self.h, ext, self.up, self.down)
+
+        m0 = g0 * self.up // self.down
+        lo = max(-(-a * self.up // self.down), self.delay)
+        hi = max(-(-b * self.up // self.down), self.delay)
+        self.hist = np.concatenate((self.hist, x))[-self.nhist:]
+        return y[lo - m0:hi - m0].astype(np.complex64)
+
+
+# Normalised cross-correlation of each row of x (n_frames, m) with the
+# reference gold (n,) or (n_frames, n) at lags 0..m-n, as n_xcorr did with
+# a loop: the numerators of all lags come from one batched FFT and the
+# norms of the sliding windows of x from running sums. Returns (lag, peak,
+# xc) with lag the position of the peak refined to a fraction of a sample
+# by fitting a parabola through it and its neighbours.
+def xcorr_align(x, gold):
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    gold = np.asarray(gold, dtype=np.float64)
+    m = x.shape[1]
+    n = gold.shape[-1]
+    nlags = m - n + 1
+
+    g = gold - gold.mean(axis=-1, keepdims=True)
+    gnorm = np.sqrt((g * g).sum(axis=-1))
+    nfft = 1 << int(m + n - 1).bit_length()
+    num = np.fft.irfft(np.fft.rfft(x, nfft) * np.conj(np.fft.rfft(g, nfft)), nfft)[:, :nlags]
+
+    s1 = np.zeros((len(x), m + 1))
+    s2 = np.zeros((len(x), m + 1))
+    np.cumsum(x, axis=1, out=s1[:, 1:])
+    np.cumsum(x * x, axis=1, out=s2[:, 1:])
+    wsum = s1[:, n:n + nlags] - s1[:, :nlags]
+    wsq = s2[:, n:n + nlags] - s2[:, :nlags]
+    den = np.sqrt(np.maximum(wsq - wsum * wsum / n, 0)) * gnorm[..., None]
+    xc = np.divide(num, den, out=np.zeros_like(num), where=den > 0)
+
+    rows = np.arange(len(x))
+    k = np.argmax(xc, axis=1)
+    peak = xc[rows, k]
+    inner = (k > 0) & (k < nlags - 1)
+    km = np.clip(k - 1, 0, nlags - 1)
+    kp = np.clip(k + 1, 0, nlags - 1)
+    curve = xc[rows, km] - 2 * peak + xc[rows, kp]
+    delta = np.divide(0.5 * (xc[rows, km] - xc[rows, kp]), curve,
+                      out=np.zeros(len(x)), where=inner & (curve < 0))
+    return k + delta, peak, xc
@@ -0,0 +1,101 @@
+# per-stage counters and timers of the adsb_read.py decode pipeline
+#
+# Counters are keyed by name and optional labels, e.g.
+# count('frames', 1, df=17, result='pass'), and timers add the seconds spent
+# in a stage and the number of calls to the stage_seconds and stage_calls
+# counters. They are only touched once per block or buffer so they can stay
+# on in production. Every interval seconds the totals, the real-time factor
+# (seconds of samples decoded per second) and any gauges are appended to a
+# file as a JSON line, or written as a Prometheus text file (replaced
+# atomically, as the node_exporter textfile collector expects).
+
+import contextlib
+import json
+import os
+import sys
+import time
+
+FORMATS = ['json', 'prom']
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(k, v) for k, v in sorted(labels.items())))
+
+
+class Metrics(object):
+    def __init__(self, fname=None, fmt='json', interval=10.0, sampling_rate=None):
+        super(Metrics, self).__init__()
+        self.fname = fname
+        self.fmt = fmt
+        self.interval = interval
+        self.sampling_rate = sampling_rate
+        self.counters = {}
+        self.gauges = {}
+        self.start = time.monotonic()
+        self.last_emit = self.start
+
+    def count(self, name, n=1, **labels):
+        key = _key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def gauge(self, name, value, **labels):
+        self.gauges[_key(name, labels)] = value
+
+    # time the block inside the with statement as stage
+    @contextlib.contextmanager
+    def timer(self, stage):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.count('stage_seconds', time.perf_counter() - t0, stage=stage)
+            self.count('stage_calls', 1, stage=stage)
+
+    # add the counters of other (a dict from take()), e.g. from a worker
+    def merge(self, counters):
+        for key, n in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    # returns the counters and resets them
+    def take(self):
+        counters, self.counters = self.counters, {}
+        return counters
+
+    def snapshot(self):
+        uptime = time.monotonic() - self.start
+        values = dict(self.counters)
+        values.update(self.gauges)
+        values['uptime_seconds'] = uptime
+        samples = self.counters.get('samples_in', 0)
+        if self.sampling_rate and uptime > 0:
+            values['realtime_factor'] = samples / self.sampling_rate / uptime
+        return values
+
+    # write the metrics if interval seconds have passed since the last time
+    # (or always with force)
+    def emit(self, force=False):
+        if self.fname is None:
+            return
+        now = time.monotonic()
+        if not force and now - self.last_emit < self.interval:
+            return
+        self.last_emit = now
+        values = self.snapshot()
+        if self.fmt == 'json':
+            line = json.dumps(dict(values, time=time.time()), sort_keys=True)
+            if self.fname == '-':
+                print(line, file=sys.stderr, flush=True)
+            else:
+                with open(self.fname, 'a') as fd:
+                    fd.write(line + '\n')
+        else:
+            tmp = self.fname + '.tmp'
+            with open(tmp, 'w') as fd:
+                for key in sorted(values):
+                    fd.write('adsb_{} {}\n'.format(key, values[key]))
+            os.replace(tmp, self.fname)
+
+    def close(self):
+        self.emit(force=True)
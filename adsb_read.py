@@ -1,291 +1,370 @@
 #!/home/phwl/anaconda3/bin/python
 
-import time
 import traceback
 import numpy as np
 import pyModeS as pms
-import statistics as stats
 import sys
-import adi
 from datetime import datetime
-import scipy.signal as sig
 import matplotlib.pyplot as plt
-import pickle
 import os
+import threading
+import queue
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import copy
 from pathlib import Path
-
-modes_frequency = 1090e6
-
-# Returns a np.array with each element of _r replicated times times
-def replicate(a, c):
-    r = []
-    for x in a:
-        r.extend([x] * c)
-    return np.array(r)
+from adsb_dsp import pbits, fbits, preamble, find_preambles, demod_frames, frames2hex, magnitudes, SampleBuffer, NoiseTracker, Resampler, replicate, msg2bin, xcorr_align
+from adsb_sources import open_source, SampleClock
+from adsb_records import RecordWriter, H5RecordWriter
+from adsb_crc import check_frames, IcaoCache, AP_DFS
+from adsb_metrics import Metrics, FORMATS
 
 
 # normalised cross-correlation
 def n_xcorr(x, y):
     "Plot normalised cross-correlation between two signals. look for best position in x (y is the reference)"
-    ynorm = y - stats.mean(y)
-    n = len(ynorm)
-    xc = np.zeros(len(x)-n)
-    
-    for i in range(len(xc)):
-        t = x[i:i+n]
-        tnorm = t - stats.mean(t)
-        xc[i] = np.dot(ynorm, tnorm) / (np.linalg.norm(ynorm, 2) * np.linalg.norm(tnorm, 2))
-    return(np.argmax(xc), xc)
-
-# generates the code for a message
-def msg2bin(msg, osr):
-    ex_msg = "".join(['10' if x == '1' else '01' for x in pms.hex2bin(msg)])
-    ex_preamble = "".join(['1' if x == 1 else '0' for x in preamble])
-    ex_full = [1 if x == '1' else 0 for x in (ex_preamble + ex_msg)]
-    return replicate(ex_full, osr)
-
-pbits = 8
-fbits = 112
-preamble = [1, 0, 1, 0, 0, 0, 0, 1, 0, 1, 0, 0, 0, 0, 0, 0]
-th_amp_diff = 0.8   # signal amplitude threshold difference between 0 and 1 bit
+    lag, peak, xc = xcorr_align(x, y)
+    return(int(np.argmax(xc[0])), xc[0])
 
 class SDRFileReader(object):
     def __init__(self, **kwargs):
         super(SDRFileReader, self).__init__()
-        self.signal_buffer = []             # amplitude of the sample only
-        self.ciq_buffer = []                # iq samples
         self.tdata = []
 
         # command line args
         self.debug = kwargs.get("debug", False)
         self.args = kwargs.get('args')
-        self.upsample = args.upsample       # replicates incoming data 
-        self.downsample = args.downsample   # decimates incoming data
-        self.osr = args.osr                 # oversampling ratio
-        self.verbose = args.verbose         # verbose mode 1=print decoded squitter, 2=stats, 3=plot
+        self.upsample = self.args.upsample      # replicates incoming data 
+        self.downsample = self.args.downsample  # decimates incoming data
+        # streaming filter for -u/-d, keeps its state from one read to the next
+        self.resampler = Resampler(self.upsample, self.downsample)
+        self.osr = self.args.osr                # oversampling ratio
+        self.verbose = self.args.verbose        # verbose mode 1=print decoded squitter, 2=stats, 3=plot
+        self.power = self.args.amplitude == 'power'     # signal holds |x|^2 rather than |x|
+        self.amp_lut = self.args.amplitude == 'lut'     # amplitudes looked up from the raw bytes
 
-        # find input source
         self.ofile = self.args.ofile
         self.ifile = self.args.ifile
         self.tfile = self.args.tfile
-        if self.ifile == None:
-            self.sdr = adi.Pluto(self.args.device)
-        elif self.ifile == '-':
-            self.fd = open(0, 'rb')
-        else:
-            self.fd = open(self.ifile, 'rb')
+        self.h5 = None                      # session training file with --h5
+        self.closed = False
 
         # member variables
         self.frames = 0
         self.fileno = 0
         self.raw_pipe_in = None
         self.stop_flag = False
-        self.noise_floor = 0.025
+        self.noise_floor = 0.025            # mean |x| of the noise, in every mode
+        self.buffer_end = 0                 # absolute index of the end of the last buffer processed
+        self.next_start = 0                 # absolute index where the search for frames resumes
+        self.icao_ttl = self.args.icao_ttl
+        self.icao_cache = IcaoCache(self.icao_ttl)
         self.preamble = replicate(preamble, self.osr)
         self.preamble_len = len(self.preamble)
 
         # sample related parameters
         self.sampling_rate = 2e6 * self.osr
         self.samples_per_microsec = 2 * self.osr
+
+        # noise floor over 100us windows
+        self.noise = NoiseTracker(self.samples_per_microsec * 100, self.sampling_rate,
+                                  self.noise_floor, self.args.noise_recovery)
         self.buffer_size = 1024 * 2000 * self.osr
         self.read_size = self.buffer_size // 2
 
-        # set up SDR (if we have one)
-        if self.ifile == None:
-            print("sample rate: {}".format(self.sampling_rate))
-            self.sdr.sample_rate = int(self.sampling_rate)
-            self.sdr.rx_rf_bandwidth = int(self.sampling_rate) 
-            self.sdr.rx_lo = int(modes_frequency)
-            self.sdr.rx_buffer_size = int(self.read_size)
-            self.sdr.gain_control_mode_chan0 = "fast_attack"
+        # find input source (radios deliver read_size samples per block,
+        # files read_size bytes of IQ pairs)
+        block_size = self.read_size if self.args.source in ['pluto', 'uhd'] else self.read_size // 2
+        self.source = open_source(self.args, block_size, self.sampling_rate)
+
+        # receive time of every sample: a capture file ends at its
+        # modification time, otherwise the clock starts with the first block
+        self.clock = SampleClock(self.sampling_rate)
+        if self.source.mtime_ns is not None:
+            duration = self.resampler.out_index(self.source.nsamples)
+            self.clock.set_start(self.source.mtime_ns - round(duration * 1e9 / self.sampling_rate))
+
+        # amplitude and iq samples waiting to be processed
+        self.samples = SampleBuffer(self.buffer_size + self.source.block_size * self.upsample,
+                                    self.power)
 
         self.exception_queue = None
 
-    def _calc_noise(self):
-        """Calculate noise floor"""
-        window = self.samples_per_microsec * 100
-        total_len = len(self.signal_buffer)
-        means = (
-            np.array(self.signal_buffer[: total_len // window * window])
-            .reshape(-1, window)
-            .mean(axis=1)
-        )
-        return min(means)
+        # capture pipeline: a pool of preallocated blocks cycles between the
+        # capture thread (free_blocks -> full_blocks) and the decoder
+        self.nblocks = self.args.queue
+        self.free_blocks = queue.Queue()
+        self.full_blocks = queue.Queue()
+        for _ in range(self.nblocks):
+            self.free_blocks.put((np.zeros(self.source.block_size, dtype=np.complex64),
+                                  np.zeros(self.source.block_size, dtype=np.float32)
+                                  if self.amp_lut else None))
+        self.blocks_read = 0
+        self.overflows = 0                  # blocks dropped because the decoder fell behind
+        self.dropped_samples = 0
+        self.max_queued = 0
+
+        # per-stage counters and timers, see adsb_metrics.py
+        self.metrics = Metrics(self.args.metrics, self.args.metrics_format,
+                               self.args.metrics_interval, self.sampling_rate)
+
+    def _update_noise(self, noise, nsamples):
+        """update the noise floor with the measurement of a new block"""
+        self.noise_floor = self.noise.apply(noise, nsamples)
+
+    def _min_sig_amp(self):
+        # 10 dB SNR, squared when the signal holds |x|^2
+        min_amp = 3.162 * self.noise_floor
+        return min_amp ** 2 if self.power else min_amp
+
+    # noise floor as an amplitude, for the training data
+    def _floor_amp(self):
+        return self.noise_floor
+
+    # amplitudes of the newest n samples for the noise floor. The floor is
+    # always the mean of |x|, so with power it is measured on the square
+    # roots: the mean of |x|^2 is not the square of the mean of |x| (4/pi
+    # times it for Rayleigh noise, more on real captures) and the gates of
+    # the two modes would differ. n can be 0 (an empty block from the
+    # resampler), which [-n:] would take as the whole buffer.
+    def _noise_signal(self, n):
+        signal = self.samples.signal()
+        signal = signal[len(signal) - n:]
+        return np.sqrt(signal) if self.power else signal
 
     def _process_buffer(self):
         """process raw IQ data in the buffer"""
 
-        # how many packets did we see
-        pkts = 0
-
         # oversampling rate is the rate above the minimum 2 MHz one
         osr = self.osr
 
-        # update noise floor
-        self.noise_floor = min(self._calc_noise(), self.noise_floor)
-
-        # set minimum signal amplitude
-        min_sig_amp = 3.162 * self.noise_floor  # 10 dB SNR
-
-        # Mode S messages
-        messages = []
+        signal_buffer = self.samples.signal()
+        ciq_buffer = self.samples.ciq()
+        offset = self.samples.pos           # absolute index of signal_buffer[0]
 
-        buffer_length = len(self.signal_buffer)
+        # the noise floor is kept up to date block by block in _read_callback
+        min_sig_amp = self._min_sig_amp()
+        self.buffer_end = self.samples.total
 
         if self.verbose >= 2:
+            print("# blocks: read", self.blocks_read, "queued", self.full_blocks.qsize(),
+                  "max queued", self.max_queued, "overflows", self.overflows,
+                  "dropped samples", self.dropped_samples)
+            if self.source.live:
+                print("# source: overflows", self.source.overflows,
+                      "dropped samples", self.source.dropped_samples)
             print("# self.noise_floor:  ", self.noise_floor)
-            print("# self.signal_buffer:  mean", stats.mean(self.signal_buffer), 
-                  "std:", stats.stdev(self.signal_buffer))
-
-        i = 0
-        while i < buffer_length:
-            if self.signal_buffer[i] < min_sig_amp:
-                i += 1
-                continue
-
-            if self._check_preamble(self.signal_buffer[i:i + pbits * 2 * osr]):
-                frame_start = i + pbits * 2 * osr
-                frame_end = i + (pbits + (fbits + 1)) * 2 * osr
-                frame_length = (fbits + 1) * 2 * osr
-                frame_pulses = self.signal_buffer[frame_start:frame_end]
-
-                threshold = max(frame_pulses) * 0.2
-
-                msgbin = []
-                for j in range(0, frame_length, 2 * osr):
-                    p2 = frame_pulses[j : j + 2 * osr]
-                    if len(p2) < 2 * osr:
-                        break
-
-                    if p2[0] < threshold and p2[osr] < threshold:
-                        break
-                    elif p2[0] >= p2[osr]:
-                        c = 1
-                    elif p2[0] < p2[osr]:
-                        c = 0
-                    else:
-                        msgbin = []
-                        break
-
-                    msgbin.append(c)
-
-                if len(msgbin) > 0:
-                    msghex = pms.bin2hex("".join([str(i) for i in msgbin]))
-                    self._debug_msg(msghex)
-                    if self._check_msg(msghex):     # we have a good message
-                        iq_window = self.ciq_buffer[i:frame_end]
-                        self.frames = self.frames + 1
-                        messages.append([msghex, time.time()])
-                        self._good_msg(msghex, iq_window)
-                    else:
-                        i += 1
-                        continue
+            print("# self.signal_buffer:  mean", signal_buffer.mean(dtype=np.float64),
+                  "std:", signal_buffer.std(dtype=np.float64, ddof=1))
 
-                # advance i with a jump
-                i = frame_start + j
-
-            else:
-                i += 1
+        # frames starting after last_start do not fit in the buffer yet,
+        # they are left in the tail for the next call
+        frame_len = (pbits + (fbits + 1)) * 2 * osr
+        last_start = self.buffer_end - frame_len
 
+        with self.metrics.timer('decode'):
+            cands = self._decode_candidates(signal_buffer, offset, offset, last_start, min_sig_amp)
+        iq_window = lambda start: self._iq_window(ciq_buffer, offset, start)
+        with self.metrics.timer('walk'):
+            messages = self._walk_candidates(cands, min_sig_amp, last_start, iq_window)
 
         # save buffer for debugging purposes
         if self.debug >= 10 and len(messages) > 0 and self.ofile is not None:
-            self._saveiqbuffer(self._complextoiq(self.ciq_buffer))
+            self._saveiqbuffer(self._complextoiq(ciq_buffer))
 
         # save the data extracted
         if len(messages) > 0:
             self._savetdata()
 
-        # reset the buffer
-        self.signal_buffer = self.signal_buffer[i:]
-        self.ciq_buffer = self.ciq_buffer[i:]
+        # keep the unprocessed tail
+        self.samples.consume(self.next_start - offset)
 
+        self._emit_metrics()
         return messages
 
-    # convert a byte array to a complex64 numpy array
-    @staticmethod
-    def _iqtocomplex(iqdata):
-        rdata = np.frombuffer(iqdata, dtype=np.uint8).astype(np.float32)
-        cdata = rdata.view(np.complex64)
-        cdata = (cdata - complex(127, 127)) / 128
-        return cdata
+    def _emit_metrics(self):
+        self.metrics.gauge('noise_floor', self._floor_amp())
+        self.metrics.gauge('queued_blocks', self.full_blocks.qsize())
+        self.metrics.gauge('overflows', self.overflows + self.source.overflows)
+        self.metrics.gauge('dropped_samples', self.dropped_samples + self.source.dropped_samples)
+        self.metrics.emit()
+
+    def _decode_candidates(self, signal_buffer, offset, first, last, min_sig_amp=-np.inf):
+        """find and demodulate every frame starting between the absolute
+        sample indices first and last, signal_buffer[0] is sample offset"""
+
+        # every position that passes the amplitude and preamble tests
+        candidates = find_preambles(signal_buffer, self.preamble, min_sig_amp, power=self.power)
+        candidates = candidates[(candidates >= first - offset) & (candidates <= last - offset)]
+
+        # demodulate and check the parity of all of them at once
+        packed, nbits, stop = demod_frames(signal_buffer, candidates, self.osr, power=self.power)
+        msgs = frames2hex(packed, nbits)
+        checks = check_frames(msgs, self.args.fix)
+        self.metrics.count('candidates', len(candidates))
+        self.metrics.count('demodulated', int(np.count_nonzero(nbits)))
+
+        return list(zip((candidates + offset).tolist(), signal_buffer[candidates].tolist(),
+                        msgs, stop.tolist(), checks))
+
+    def _iq_window(self, ciq_buffer, offset, start):
+        """copy of the iq samples of the frame at absolute index start, with
+        osr samples before it (zero if already consumed) for the alignment"""
+        frame_len = (pbits + (fbits + 1)) * 2 * self.osr
+        lo = start - offset - self.osr
+        window = ciq_buffer[max(lo, 0):start - offset + frame_len]
+        if lo < 0:
+            return np.concatenate((np.zeros(-lo, dtype=window.dtype), window))
+        return window.copy()
+
+    def _walk_candidates(self, cands, min_sig_amp, last_start, iq_window):
+        """go through the decoded candidates in sample order, skipping those
+        inside a frame already found, and return the good messages as
+        [msg, time, start]"""
+
+        osr = self.osr
+
+        # Mode S messages
+        messages = []
+
+        i = self.next_start
+        for start, amp, msghex, stop, (good, addr, df) in cands:
+            # skip weak and already decoded candidates
+            if start < i or amp < min_sig_amp:
+                continue
+            i = start
+            result = 'fail'
+
+            if good is not None and self.icao_ttl > 0:
+                # address/parity replies are only trusted from aircraft
+                # recently heard in a squitter
+                t = start / self.sampling_rate
+                if df in AP_DFS:
+                    if not self.icao_cache.has(addr, t):
+                        good = None
+                        result = 'unknown_icao'
+                else:
+                    self.icao_cache.add(addr, t)
+
+            if msghex is not None:
+                self.metrics.count('frames', df=df, result=result if good is None else 'pass')
+                self._debug_msg(msghex, good)
+                if good is not None:            # we have a good (maybe corrected) message
+                    self.frames = self.frames + 1
+                    messages.append([good, self.clock(start) / 1e9, start])
+                    self._good_msg(good, iq_window(start), start)
+                else:
+                    i += 1
+                    continue
+
+            # advance i with a jump
+            i = start + (pbits + stop) * 2 * osr
+
+        self.next_start = max(i, last_start + 1)
+
+        return messages
 
     # convert a complex64 numpy array to a byte array
     @staticmethod
     def _complextoiq(cdata):
-        rdata = np.array(cdata).view(np.float64) * 128 + 127
+        rdata = np.asarray(cdata, dtype=np.complex64).view(np.float32) * 128 + 127
         iq = rdata.astype(np.uint8)
         return iq
 
     # save the NN training set
     def _savetdata(self):
         if self.tfile is not None:
-            while True:
-                fname = '{}-{}-tdata.bin'.format(self.tfile, self.fileno)
-                if not os.path.isfile(fname):
-                    break
-                self.fileno += 1
-            print("Writing training file to", fname, flush=True)
-            
-            # Ensure the parent directory path exists 
-            parent = Path(fname).resolve().parent
-            parent.mkdir(parents=True, exist_ok=True)
-            with open(fname, "wb") as fd:
-                pickle.dump(self.tdata, fd)
+            with self.metrics.timer('tdata_write'):
+                timestamps, windows, msgs, noise, frames, starts = zip(*self.tdata)
+                align, corr = self._align(frames, msgs)
+                if self.h5 is None:
+                    fname = self._new_tfile('tdata.bin' if not self.args.h5 else 'tdata.h5')
+                    if self.args.h5:
+                        # one file for the whole session
+                        self.h5 = H5RecordWriter(fname, self.osr, self.sampling_rate, len(windows[0]),
+                                                 compression=self.args.h5_compression)
+                if self.h5 is not None:
+                    self.h5.write(timestamps, np.stack(windows), msgs, noise, align, corr, starts)
+                else:
+                    with RecordWriter(fname, self.osr, self.sampling_rate, len(windows[0])) as fd:
+                        fd.write(timestamps, np.stack(windows), msgs, align, corr, starts)
         self.tdata = []
 
+    def _align(self, frames, msgs):
+        """offset (in samples, from the start of the training vector) and peak
+        of the normalised cross-correlation of each frame with its ideal
+        waveform, searched over +-osr samples"""
+        osr = self.osr
+        align = np.zeros(len(msgs), dtype=np.float32)
+        corr = np.zeros(len(msgs), dtype=np.float32)
+        frames = np.abs(np.stack(frames))
+        lens = np.array([len(msg) for msg in msgs])
+        for msglen in np.unique(lens):
+            rows = np.flatnonzero(lens == msglen)
+            gold = np.stack([msg2bin(msgs[r], osr) for r in rows])
+            n = gold.shape[1]
+            lag, peak, xc = xcorr_align(frames[rows, :n + 2 * osr], gold)
+            align[rows] = lag - osr
+            corr[rows] = peak
+        return align, corr
+
+    # first unused training file name ending in suffix
+    def _new_tfile(self, suffix):
+        while True:
+            fname = '{}-{}-{}'.format(self.tfile, self.fileno, suffix)
+            if not os.path.isfile(fname):
+                break
+            self.fileno += 1
+        print("Writing training file to", fname, flush=True)
+
+        # Ensure the parent directory path exists 
+        parent = Path(fname).resolve().parent
+        parent.mkdir(parents=True, exist_ok=True)
+        return fname
+
+    # flushes the outputs and stops the input, once (stop and the end of a
+    # run both come here)
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.h5 is not None:
+            self.h5.close()
+            self.h5 = None
+        self.metrics.close()
+        self.source.close()
+
     # save an entire iq buffer
     def _saveiqbuffer(self, frame):
         # append info to index file
         fname = '{}-{}.iq'.format(self.ofile, self.frames)
         ft = open('{}-iqindex.txt'.format(self.ofile), 'a')
         ft.write('({},{},{})\n'.format(
-                 fname, datetime.now(), self.noise_floor))
+                 fname, datetime.now(), self._floor_amp()))
         ft.close()
         # write binary iq samples
         fs = open(fname, 'wb')
         fs.write(frame)
         fs.close()
 
-    def _check_preamble(self, pulses):
-        if len(pulses) != self.preamble_len:
-            return False
-
-        for i in range(self.preamble_len):
-            if abs(pulses[i] - self.preamble[i]) > th_amp_diff:
-                return False
+    # returns the message, corrected if needed, or None if it fails the parity check
+    def _check_msg(self, msg):
+        return check_frames([msg], self.args.fix)[0][0]
 
-        return True
+    def _good_msg(self, msg, iq_window, start):
+        # iq_window are our raw samples, starting osr samples before the
+        # frame at sample index start; the alignment is found for all frames
+        # at once in _savetdata
+        besti = self.osr
 
-    def _check_msg(self, msg):
-        df = pms.df(msg)
-        msglen = len(msg)
-        if df == 17 and msglen == 28:
-            if pms.crc(msg) == 0:
-                return True
-        elif df in [20, 21] and msglen == 28:
-            return True
-        elif df in [4, 5, 11] and msglen == 14:
-            return True
-
-    def _good_msg(self, msg, iq_window):
-        # iq_window are our raw samples find the best alignment
-        frame_window = amp = np.absolute(iq_window)
-
-        # generate the expected time domain waveform from the message
-        gold_msg = msg2bin(msg, self.osr) * 0.5
-
-        # correlate gold message to find best alignment
-        # (besti, xc) = n_xcorr(np.array(frame_window), np.array(gold_msg))
-        besti = 0
-
-        # generate DNN training vector
-        n = len(gold_msg)
+        # generate DNN training vector, a fixed length window that holds
+        # the longest squitter
+        n = (len(preamble) + 2 * fbits) * self.osr
         d_in = iq_window[besti:besti+n]
         d_out = msg
-        dtime = str(datetime.now())
+        dtime = self.clock(start)
 
-        self.tdata.append((dtime, d_in, d_out))
+        self.tdata.append((dtime, d_in, d_out, self._floor_amp(), iq_window, start))
 
         if self.verbose >= 4:
             # make plot
@@ -298,9 +377,10 @@ class SDRFileReader(object):
             #plt.show()
             pass
 
-    def _debug_msg(self, msg):
-        df = pms.df(msg)
-        if self._check_msg(msg):
+    def _debug_msg(self, msg, good):
+        if good is not None:
+            msg = good
+            df = pms.df(msg)
             msglen = len(msg)
             if df == 17 and msglen == 28:
                 print(self.frames, ":", msg, pms.icao(msg), pms.crc(msg), flush=True)
@@ -312,59 +392,284 @@ class SDRFileReader(object):
             print("X", ":", msg, flush=True)
 
 
-    def _read_callback(self, cdata, rtlsdr_obj):
-        # scale to be in range [-1,1)
-        if self.upsample > 1:
-            cdata = replicate(cdata, self.upsample)
-        amp = np.absolute(cdata)
-        self.signal_buffer.extend(amp.tolist())
-        self.ciq_buffer.extend(cdata.tolist())
+    def _read_callback(self, cdata, rtlsdr_obj, amp=None):
+        self.samples.append(cdata, amp)
+        self.metrics.count('samples_in', len(cdata))
+        with self.metrics.timer('noise'):
+            self._update_noise(self.noise.measure(self._noise_signal(len(cdata))), len(cdata))
 
-        if len(self.signal_buffer) >= self.buffer_size:
+        if self.samples.total - self.buffer_end >= self.buffer_size:
             messages = self._process_buffer()
             self.handle_messages(messages)
 
     def handle_messages(self, messages):
-        """re-implement this method to handle the messages"""
-        #for msg, t in messages:
+        """re-implement this method to handle the messages, a list of
+        [msg, time, sample index of the start of the preamble]"""
+        #for msg, t, start in messages:
             #print("%15.9f %s" % (t, msg))
             #pass
 
     def stop(self, *args, **kwargs):
+        self.close()
         sys.exit()
 
+    # read the next block of samples into block, an (iq, amp) pair, returns
+    # the number of samples (0 at the end of the input); amp is None unless
+    # the amplitudes are looked up from the raw bytes
+    def _read_block(self, block):
+        iq, amp = block
+        if amp is None:
+            return self.source.read(iq)
+        return self.source.read(iq, amp)
+
+    # the first n samples of a block, and their amplitudes if looked up,
+    # at the decoder's sample rate
+    def _resample(self, block, n):
+        iq, amp = block
+        cdata = self.resampler(iq[:n])
+        if amp is not None:
+            amp = replicate(amp[:n], self.upsample)     # no downsampling with lut
+        return cdata, amp
+
+    # position the input so the next _read_block returns read number j
+    def _seek_read(self, j):
+        self.source.seek(j * self.source.block_size)
+
+    def _capture(self):
+        """capture thread: only moves samples from the input to the decoder,
+        with the number of samples lost since the block before"""
+        scratch = None
+        lost = 0
+        try:
+            while True:
+                try:
+                    block = self.free_blocks.get_nowait()
+                except queue.Empty:
+                    if not self.source.live:
+                        # files can wait for the decoder
+                        block = self.free_blocks.get()
+                    else:
+                        # keep the radio streaming and drop the block
+                        if scratch is None:
+                            scratch = np.zeros(self.source.block_size, dtype=np.complex64)
+                        self.overflows += 1
+                        self.dropped_samples += self.source.read(scratch)
+                        continue
+
+                with self.metrics.timer('read'):
+                    n = self._read_block(block)
+                if not self.clock.started:
+                    # the last sample of the first block was taken about now
+                    self.clock.start(n * self.upsample / self.downsample)
+                dropped = self.dropped_samples + self.source.dropped_samples - lost
+                lost += dropped
+                self.blocks_read += 1
+                self.full_blocks.put((block, n, dropped))
+                self.max_queued = max(self.max_queued, self.full_blocks.qsize())
+                if n == 0:
+                    break
+        except Exception as e:
+            self.full_blocks.put((e, 0, 0))
+
     def run(self, raw_pipe_in=None, stop_flag=None, exception_queue=None):
         self.raw_pipe_in = raw_pipe_in
         self.exception_queue = exception_queue
         self.stop_flag = stop_flag
 
-        while True:
-            # raw data are unsigned bytes (as IQ samples)
-            if self.ifile == None:
-                cdata = self.sdr.rx() / 256
-            else:
-                iqdata = self.fd.read(self.read_size)
-                cdata = self._iqtocomplex(iqdata)
-            if len(cdata) == 0:
-                break
-            if self.downsample > 1:
-                cdata = sig.decimate(cdata, self.downsample)
-            self._read_callback(cdata, None)
+        capture = threading.Thread(target=self._capture, daemon=True)
+        capture.start()
+
+        # the input is closed however the decoding ends, so a radio stops
+        # streaming
+        try:
+            while True:
+                block, n, dropped = self.full_blocks.get()
+                if isinstance(block, Exception):
+                    raise block
+                if n == 0:
+                    break
+                if dropped > 0:
+                    self.clock.skip(self.samples.total, dropped * self.upsample / self.downsample)
+                with self.metrics.timer('resample'):
+                    cdata, amp = self._resample(block, n)
+                self._read_callback(cdata, None, amp)
+                self.free_blocks.put(block)
+
+            capture.join()
+        finally:
+            self.close()
+
+    # number of samples each read of the input file adds to the buffer and
+    # the reads after which _read_callback processes the buffer, together
+    # with the absolute sample index at which each of those buffers ends
+    def _read_schedule(self):
+        nsamples = self.source.nsamples
+        block_size = self.source.block_size
+        read_starts = np.array([self.resampler.out_index(pos)
+                                for pos in list(range(0, nsamples, block_size)) + [nsamples]],
+                               dtype=np.int64)
+        counts = np.diff(read_starts)
+
+        buffer_reads = []
+        buffer_ends = []
+        end = 0
+        for j in range(len(counts)):
+            if read_starts[j + 1] - end >= self.buffer_size:
+                end = int(read_starts[j + 1])
+                buffer_reads.append(j)
+                buffer_ends.append(end)
+        return read_starts, buffer_reads, buffer_ends
+
+    # approximate memory (bytes) of the sample buffers of one decoder with a
+    # single block: the amplitude and iq buffer holds a buffer and one
+    # upsampled read (12 bytes a sample), the block one read and the
+    # resampler output one upsampled read (8 bytes a sample). About 3 GB
+    # at -u16 -r16, 40 MB at -r1.
+    def buffer_memory(self):
+        block = self.source.block_size
+        return 12 * len(self.samples.iq) + 8 * block + 8 * self.resampler.out_index(block)
+
+    def run_workers(self, workers):
+        """decode the input file in chunks of buffers with a process pool,
+        giving the same output as run(). Each process has the buffers of a
+        full decoder (see buffer_memory), and if one dies, e.g. killed for
+        running out of memory, the pool is broken and this raises rather
+        than wait for its results"""
+        read_starts, buffer_reads, buffer_ends = self._read_schedule()
+        nbuffers = len(buffer_ends)
+        per_chunk = max(1, nbuffers // (4 * workers))
+
+        # each chunk also reads the block before it, which overlaps the
+        # previous chunk by more than one frame so no squitter is lost
+        chunks = []
+        for k0 in range(0, nbuffers, per_chunk):
+            k1 = min(k0 + per_chunk, nbuffers)
+            first_read = buffer_reads[k0 - 1] if k0 > 0 else 0
+            prev_end = buffer_ends[k0 - 1] if k0 > 0 else 0
+            chunks.append((first_read, buffer_reads[k1 - 1], int(read_starts[first_read]),
+                           prev_end, buffer_ends[k0:k1]))
+
+        # merge in sample order, the walk drops frames seen twice in the overlap
+        frame_len = (pbits + (fbits + 1)) * 2 * self.osr
+        pool = ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(self.args,))
+        try:
+            for results, counters in pool.map(_decode_chunk, chunks):
+                self.metrics.merge(counters)
+                for noise, cands, windows, buffer_end in results:
+                    for block_noise, nsamples in noise:
+                        self._update_noise(block_noise, nsamples)
+                        self.metrics.count('samples_in', nsamples)
+                    min_sig_amp = self._min_sig_amp()
+                    self.buffer_end = buffer_end
+                    with self.metrics.timer('walk'):
+                        messages = self._walk_candidates(cands, min_sig_amp, buffer_end - frame_len,
+                                                         windows.__getitem__)
+                    if len(messages) > 0:
+                        self._savetdata()
+                    self.handle_messages(messages)
+                    self._emit_metrics()
+        except BrokenProcessPool as e:
+            raise RuntimeError("a decoder process died (each needs about {:.0f} MB, "
+                               "try fewer --workers)".format(self.buffer_memory() / 2**20)) from e
+        finally:
+            pool.shutdown(cancel_futures=True)
+            self.close()
+
+    def _decode_chunk(self, first_read, last_read, pos, prev_end, buffer_ends):
+        """worker side of run_workers: decode the buffers ending at
+        buffer_ends from reads first_read..last_read, the first read starts
+        at absolute sample pos and the buffer before ends at prev_end"""
+        frame_len = (pbits + (fbits + 1)) * 2 * self.osr
+        self._seek_read(first_read)
+        self.samples.reset(pos)
+        self.noise = NoiseTracker(self.noise.window, self.sampling_rate, pos=pos)
+        self.resampler = Resampler(self.upsample, self.downsample,
+                                   pos=first_read * self.source.block_size)
+        block = self.free_blocks.get()
+
+        results = []
+        noise = []                          # (measurement, samples) of the reads since prev_end
+        for j in range(first_read, last_read + 1):
+            with self.metrics.timer('read'):
+                n = self._read_block(block)
+            with self.metrics.timer('resample'):
+                cdata, amp = self._resample(block, n)
+            read_start = self.samples.total
+            self.samples.append(cdata, amp)
+
+            # the first read was measured by the chunk before
+            with self.metrics.timer('noise'):
+                block_noise = self.noise.measure(self._noise_signal(len(cdata)))
+            if read_start >= prev_end:
+                noise.append((block_noise, len(cdata)))
+
+            end = buffer_ends[len(results)]
+            if self.samples.total < end:
+                continue
 
+            signal_buffer = self.samples.signal()
+            ciq_buffer = self.samples.ciq()
+            offset = self.samples.pos
 
+            # everything the serial walk could visit in this buffer, with
+            # the iq windows of the frames that pass the parity check
+            with self.metrics.timer('decode'):
+                cands = self._decode_candidates(signal_buffer, offset, prev_end - frame_len + 1,
+                                                end - frame_len)
+            windows = {}
+            for start, amp, msghex, stop, (good, addr, df) in cands:
+                if good is not None:
+                    windows[start] = self._iq_window(ciq_buffer, offset, start)
 
-if __name__ == "__main__":
-    import signal
+            results.append((noise, cands, windows, end))
+            noise = []
+            prev_end = end
+            self.samples.consume(end - frame_len + 1 - offset)
+
+        self.free_blocks.put(block)
+        return results, self.metrics.take()
+
+
+# SDRFileReader used by each run_workers process
+_worker = None
+
+def _init_worker(args):
+    global _worker
+    args = copy.copy(args)
+    args.queue = 1
+    args.metrics = None                 # counters go back to the parent with the results
+    _worker = SDRFileReader(args=args)
+
+def _decode_chunk(chunk):
+    return _worker._decode_chunk(*chunk)
+
+
+# command line options of adsb_read.py, also used to set up an SDRFileReader
+# from other scripts (argv None parses sys.argv)
+def parse_args(argv=None):
     import argparse
 
     # parse command line
     parser = argparse.ArgumentParser()
     parser.add_argument('-i', '--ifile', action='store', 
                         default=None, help='Input file name')
+    parser.add_argument('-m', '--mmap', action='store_true',
+                        help='Memory-map the input file instead of reading it')
     parser.add_argument('-o', '--ofile', action='store', 
                         default=None, help='Output file prefix')
     parser.add_argument('-t', '--tfile', action='store', 
                         default=None, help='Output training set file')
+    parser.add_argument('--h5', action='store_true',
+                        help='Write the training set of the session to a single HDF5 file')
+    parser.add_argument('--h5-compression', choices=['gzip', 'lzf'], default=None,
+                        help='Compression of the HDF5 training set')
+    parser.add_argument('-f', '--fix', type=int, choices=[0, 1, 2], default=1,
+                        help='Number of bit errors corrected in DF11/DF17 squitters')
+    parser.add_argument('--icao-ttl', type=float, default=60,
+                        help='Seconds an ICAO address heard in a DF11/DF17 squitter validates '
+                             'DF4/5/20/21 replies (0 accepts all replies)')
+    parser.add_argument('--noise-recovery', type=float, default=10,
+                        help='Time constant (s) with which the noise floor rises (0 follows each block)')
     parser.add_argument('-r', '--osr', type=int, default=1, 
                         help='Oversampling ratio')
     parser.add_argument('-v', '--verbose', action='count', default=0,
@@ -375,10 +680,44 @@ if __name__ == "__main__":
                         help='Upsample factor')
     parser.add_argument('-d', '--downsample', type=int, default=1, 
                         help='Downsample factor')
+    parser.add_argument('-a', '--amplitude', choices=magnitudes, default='abs',
+                        help='Amplitude front end: abs |x|, power |x|^2 (no square root) or '
+                             'lut (looked up from the raw bytes of a file)')
+    parser.add_argument('-s', '--source', choices=['pluto', 'uhd', 'file', 'synthetic'],
+                        default=None, help='Sample source (default: file with -i, else pluto)')
     parser.add_argument('-D', '--device', action='store', 
-                        default='ip:pluto.local', help='pluto device name')
-    args = parser.parse_args()
+                        default=None, help='SDR device name (pluto: ip:pluto.local, uhd: type=b200)')
+    parser.add_argument('-g', '--gain', type=float, default=73,
+                        help='UHD receive gain (dB)')
+    parser.add_argument('--metrics', action='store', default=None,
+                        help='Write pipeline counters and timers to this file (- for stderr)')
+    parser.add_argument('--metrics-format', choices=FORMATS, default='json',
+                        help='Metrics as appended JSON lines or a Prometheus text file')
+    parser.add_argument('--metrics-interval', type=float, default=10,
+                        help='Seconds between metrics updates')
+    parser.add_argument('-q', '--queue', type=int, default=4,
+                        help='Number of sample blocks buffered between capture and decoding')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Decode the input file with this many processes, each with '
+                             'the memory of a single decoder (about 3 GB at -u16 -r16)')
+    args = parser.parse_args(argv)
+    if args.source is None:
+        args.source = 'pluto' if args.ifile is None else 'file'
+    if args.source == 'file' and args.ifile is None:
+        parser.error('--source file needs an input file')
+    if args.amplitude == 'lut' and (args.source != 'file' or args.downsample > 1):
+        parser.error('--amplitude lut needs an input file and no downsampling')
+    if args.mmap and (args.source != 'file' or not os.path.isfile(args.ifile)):
+        parser.error('--mmap needs a regular input file')
+    if args.workers > 1 and (args.source != 'file' or args.ifile == '-'):
+        parser.error('--workers needs an input file')
+    return args
+
+
+if __name__ == "__main__":
+    import signal
 
+    args = parse_args()
 
     # create SDR object
     rtl = SDRFileReader(args = args)
@@ -390,5 +729,7 @@ if __name__ == "__main__":
     if (args.profile):
         import cProfile
         cProfile.run('rtl.run()')
+    elif args.workers > 1:
+        rtl.run_workers(args.workers)
     else:
         rtl.run()
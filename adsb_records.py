@@ -0,0 +1,342 @@
+# training record files written by adsb_read.py
+#
+# A file is a 64 byte header followed by fixed-width records, appended as
+# squitters are captured:
+#
+#   timestamp   int64           receive time of the first preamble sample,
+#                               ns since the epoch (UTC), see SampleClock
+#   iq          complex64[w]    iq samples from the start of the preamble,
+#                               long enough for a 112 bit squitter whatever
+#                               the message length (or int8[w, 2] scaled
+#                               by iq_scale)
+#   msg         uint8[14]       the message, packed two hex digits per byte
+#   msglen      uint8           length of the message in hex digits
+#   align       float32         offset (samples) of the best match of the
+#                               ideal waveform from the start of iq
+#   corr        float32         normalised cross-correlation at that offset
+#   sample      int64           index of the first preamble sample in the
+#                               capture (at the decoder's sample rate)
+#
+# so a file can be memory-mapped and used as a numpy structured array
+# without parsing. Files written by older versions (pickled lists of
+# (str(datetime), ndarray, hexstring) tuples) can still be read with
+# load_tdata, and their timestamps converted with timestamps_ns.
+#
+# With --h5 a capture session instead goes to a single HDF5 file with the
+# resizable datasets timestamp, iq, msg (hex strings), noise_floor, align,
+# corr and sample, see H5RecordWriter.
+
+import numpy as np
+import os
+import pickle
+import time
+
+MAGIC = b'ADSBTREC'
+VERSION = 3             # version 1 had no align and corr, version 2 no sample
+IQ_TYPES = ['complex64', 'int8']
+MSG_BYTES = 14
+
+header_dtype = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u2'),
+    ('iq_type', 'u1'),
+    ('reserved0', 'u1'),
+    ('osr', '<u2'),
+    ('reserved1', '<u2'),
+    ('window', '<u4'),
+    ('reserved2', '<u4'),
+    ('sample_rate', '<f8'),
+    ('iq_scale', '<f8'),
+    ('reserved3', 'V24'),
+])
+assert header_dtype.itemsize == 64
+
+
+# dtype of one record holding an iq window of window samples
+def record_dtype(window, iq_type='complex64', version=VERSION):
+    if iq_type == 'complex64':
+        iq = ('iq', '<c8', (window,))
+    elif iq_type == 'int8':
+        iq = ('iq', 'i1', (window, 2))
+    else:
+        raise ValueError("unknown iq type {}".format(iq_type))
+    fields = [('timestamp', '<i8'), iq, ('msg', 'u1', (MSG_BYTES,)), ('msglen', 'u1')]
+    if version >= 2:
+        fields += [('align', '<f4'), ('corr', '<f4')]
+    if version >= 3:
+        fields += [('sample', '<i8')]
+    return np.dtype(fields)
+
+
+def make_header(osr, sample_rate, window, iq_type='complex64', iq_scale=128.0):
+    header = np.zeros(1, dtype=header_dtype)
+    header['magic'] = MAGIC
+    header['version'] = VERSION
+    header['iq_type'] = IQ_TYPES.index(iq_type)
+    header['osr'] = osr
+    header['window'] = window
+    header['sample_rate'] = sample_rate
+    header['iq_scale'] = iq_scale
+    return header
+
+
+# header fields as a dict, raises ValueError if buf is not a record file header
+def parse_header(buf):
+    if len(buf) < header_dtype.itemsize or bytes(buf[:len(MAGIC)]) != MAGIC:
+        raise ValueError("not an ADS-B training record file")
+    h = np.frombuffer(buf[:header_dtype.itemsize], dtype=header_dtype)[0]
+    if not 1 <= h['version'] <= VERSION:
+        raise ValueError("unsupported record file version {}".format(h['version']))
+    return {
+        'version': int(h['version']),
+        'osr': int(h['osr']),
+        'sample_rate': float(h['sample_rate']),
+        'window': int(h['window']),
+        'iq_type': IQ_TYPES[h['iq_type']],
+        'iq_scale': float(h['iq_scale']),
+    }
+
+
+# pack hex message strings into the msg and msglen fields
+def pack_msgs(msgs):
+    packed = np.zeros((len(msgs), MSG_BYTES), dtype=np.uint8)
+    msglen = np.zeros(len(msgs), dtype=np.uint8)
+    for k, msg in enumerate(msgs):
+        b = bytes.fromhex(msg + '0' * (len(msg) % 2))
+        packed[k, :len(b)] = np.frombuffer(b, dtype=np.uint8)
+        msglen[k] = len(msg)
+    return packed, msglen
+
+
+class RecordWriter(object):
+    """append-only writer, an existing file is appended to if its header
+    matches"""
+
+    def __init__(self, fname, osr, sample_rate, window, iq_type='complex64', iq_scale=128.0):
+        super(RecordWriter, self).__init__()
+        self.dtype = record_dtype(window, iq_type)
+        self.iq_type = iq_type
+        self.iq_scale = iq_scale
+        self.window = window
+
+        if os.path.isfile(fname) and os.path.getsize(fname) > 0:
+            with open(fname, 'rb') as fd:
+                header = parse_header(fd.read(header_dtype.itemsize))
+            if header != {'version': VERSION, 'osr': osr, 'sample_rate': float(sample_rate),
+                          'window': window, 'iq_type': iq_type, 'iq_scale': float(iq_scale)}:
+                raise ValueError("{} was written with different settings".format(fname))
+            self.fd = open(fname, 'ab')
+        else:
+            self.fd = open(fname, 'wb')
+            self.fd.write(make_header(osr, sample_rate, window, iq_type, iq_scale).tobytes())
+
+    # append records from timestamps (ns), iq windows (n, window) and hex
+    # messages, with their alignment offsets, correlation peaks and sample
+    # indices
+    def write(self, timestamps, iq, msgs, align=0.0, corr=0.0, sample=0):
+        rec = np.zeros(len(msgs), dtype=self.dtype)
+        rec['timestamp'] = timestamps
+        rec['align'] = align
+        rec['corr'] = corr
+        rec['sample'] = sample
+        iq = np.asarray(iq).reshape(len(msgs), self.window)
+        if self.iq_type == 'complex64':
+            rec['iq'] = iq
+        else:
+            rec['iq'][..., 0] = np.clip(np.rint(iq.real * self.iq_scale), -128, 127)
+            rec['iq'][..., 1] = np.clip(np.rint(iq.imag * self.iq_scale), -128, 127)
+        rec['msg'], rec['msglen'] = pack_msgs(msgs)
+        self.fd.write(rec.tobytes())
+
+    def close(self):
+        self.fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class H5RecordWriter(object):
+    """appends records to the chunked, resizable datasets of an HDF5 file
+    (needs h5py), flushing at most every flush_interval seconds"""
+
+    def __init__(self, fname, osr, sample_rate, window, compression=None,
+                 chunk=256, flush_interval=10.0):
+        super(H5RecordWriter, self).__init__()
+        import h5py
+
+        self.window = window
+        self.flush_interval = flush_interval
+        self.h5 = h5py.File(fname, 'a')
+        if 'timestamp' in self.h5:
+            if (self.h5.attrs['version'], self.h5.attrs['osr'], self.h5.attrs['window']) != (VERSION, osr, window):
+                raise ValueError("{} was written with different settings".format(fname))
+        else:
+            self.h5.attrs['version'] = VERSION
+            self.h5.attrs['osr'] = osr
+            self.h5.attrs['sample_rate'] = sample_rate
+            self.h5.attrs['window'] = window
+            self.h5.create_dataset('timestamp', (0,), maxshape=(None,), dtype='<i8',
+                                   chunks=(chunk,), compression=compression)
+            self.h5.create_dataset('iq', (0, window), maxshape=(None, window), dtype='<c8',
+                                   chunks=(chunk, window), compression=compression)
+            self.h5.create_dataset('msg', (0,), maxshape=(None,), dtype='S{}'.format(2 * MSG_BYTES),
+                                   chunks=(chunk,), compression=compression)
+            for name in ['noise_floor', 'align', 'corr']:
+                self.h5.create_dataset(name, (0,), maxshape=(None,), dtype='<f4',
+                                       chunks=(chunk,), compression=compression)
+            self.h5.create_dataset('sample', (0,), maxshape=(None,), dtype='<i8',
+                                   chunks=(chunk,), compression=compression)
+        self.last_flush = time.monotonic()
+
+    def __len__(self):
+        return len(self.h5['timestamp'])
+
+    def write(self, timestamps, iq, msgs, noise_floor=0.0, align=0.0, corr=0.0, sample=0):
+        n = len(msgs)
+        k = len(self)
+        for name in ['timestamp', 'iq', 'msg', 'noise_floor', 'align', 'corr', 'sample']:
+            self.h5[name].resize(k + n, axis=0)
+        self.h5['timestamp'][k:] = timestamps
+        self.h5['iq'][k:] = np.asarray(iq).reshape(n, self.window)
+        self.h5['msg'][k:] = np.array(msgs, dtype='S{}'.format(2 * MSG_BYTES))
+        self.h5['noise_floor'][k:] = noise_floor
+        self.h5['align'][k:] = align
+        self.h5['corr'][k:] = corr
+        self.h5['sample'][k:] = sample
+
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.h5.flush()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.h5.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# True if fname is an HDF5 file written by H5RecordWriter
+def is_h5_tdata(fname):
+    with open(fname, 'rb') as fd:
+        if fd.read(8) != b'\x89HDF\r\n\x1a\n':
+            return False
+    import h5py
+    with h5py.File(fname, 'r') as h5:
+        return all(name in h5 for name in ['timestamp', 'iq', 'msg'])
+
+
+# Returns (header, records) where records is a structured array with the
+# fields above, memory-mapped unless mmap is False. A partly written last
+# record is ignored.
+def read_records(fname, mmap=True):
+    with open(fname, 'rb') as fd:
+        header = parse_header(fd.read(header_dtype.itemsize))
+    dtype = record_dtype(header['window'], header['iq_type'], header['version'])
+    nrec = (os.path.getsize(fname) - header_dtype.itemsize) // dtype.itemsize
+    if mmap and nrec > 0:
+        rec = np.memmap(fname, dtype=dtype, mode='r', offset=header_dtype.itemsize, shape=(nrec,))
+    else:
+        rec = np.fromfile(fname, dtype=dtype, count=nrec, offset=header_dtype.itemsize)
+    return header, rec
+
+
+# iq windows of records as complex64 (n, window)
+def records_iq(header, rec):
+    if header['iq_type'] == 'complex64':
+        return rec['iq']
+    iq = rec['iq'].astype(np.float32) / np.float32(header['iq_scale'])
+    return iq.view(np.complex64)[..., 0]
+
+
+# hex message strings of records
+def records_msgs(rec):
+    return [bytes(m).hex().upper()[:n] for m, n in zip(rec['msg'], rec['msglen'].tolist())]
+
+
+# receive times of records as numpy datetime64[ns]
+def records_times(rec):
+    return rec['timestamp'].astype('datetime64[ns]')
+
+
+# sample indices of records (-1 for files written before version 3)
+def records_samples(rec):
+    if 'sample' not in rec.dtype.names:
+        return np.full(len(rec), -1, dtype=np.int64)
+    return rec['sample']
+
+
+# Converts timestamps of any of the forms found in training files
+# (datetime64, datetime, the str(datetime) strings of the pickled files or
+# ns since the epoch) to int64 ns since the epoch, with one array conversion
+# rather than one np.datetime64 per record. datetime64 values are UTC, as
+# written by RecordWriter; the datetimes and strings of the pickled files
+# came from datetime.now() and are naive wall times, so they are taken as
+# local time, or as time zone tz (a tzinfo) if the capture was made elsewhere.
+# A mix of the two (a directory of old and new files gives an object array)
+# only has the naive entries shifted.
+def timestamps_ns(dtimes, tz=None):
+    from datetime import datetime
+
+    if len(dtimes) == 0:
+        return np.zeros(0, dtype=np.int64)
+    dtimes = np.asarray(dtimes)
+    if dtimes.dtype.kind in 'iu':
+        return dtimes.astype(np.int64)
+    ns = dtimes.astype('datetime64[ns]').astype(np.int64)
+    if dtimes.dtype.kind == 'M':
+        return ns
+    if dtimes.dtype.kind == 'O':
+        naive = np.array([isinstance(t, (str, datetime)) for t in dtimes.ravel()],
+                         dtype=bool).reshape(dtimes.shape)
+    else:
+        naive = np.ones(dtimes.shape, dtype=bool)
+    ns[naive] -= _utc_offsets_ns(ns[naive], tz)
+    return ns
+
+
+# UTC offsets (ns) of the wall times wall_ns (ns since 1970-01-01 00:00 wall
+# time) in tz or, for None, the local time zone. Offsets only change on the
+# hour, so they are looked up once per distinct hour.
+def _utc_offsets_ns(wall_ns, tz):
+    from datetime import datetime, timedelta
+
+    hour_ns = 3600 * 10**9
+    hours, index = np.unique(wall_ns // hour_ns, return_inverse=True)
+    offsets = np.zeros(len(hours), dtype=np.int64)
+    for k, h in enumerate(hours.tolist()):
+        wall = datetime(1970, 1, 1) + timedelta(hours=h)
+        wall = wall.astimezone() if tz is None else wall.replace(tzinfo=tz)
+        offsets[k] = wall.utcoffset() // timedelta(microseconds=1) * 1000
+    return offsets[index.reshape(-1)]
+
+
+# Returns the records of a training file as a list of (dtime, d_in, d_out)
+# tuples, for either format. As in the pickled files, d_in only covers the
+# preamble and the bits of d_out.
+def load_tdata(fname):
+    if is_h5_tdata(fname):
+        import h5py
+        with h5py.File(fname, 'r') as h5:
+            osr = int(h5.attrs['osr'])
+            times = h5['timestamp'][:].astype('datetime64[ns]')
+            iq = h5['iq'][:]
+            msgs = [m.decode() for m in h5['msg'][:]]
+    else:
+        with open(fname, 'rb') as fd:
+            magic = fd.read(len(MAGIC))
+            if magic != MAGIC:
+                fd.seek(0)
+                return pickle.load(fd)
+        header, rec = read_records(fname)
+        osr = header['osr']
+        times, iq, msgs = records_times(rec), records_iq(header, rec), records_msgs(rec)
+    return [(t, x[:(16 + 8 * len(msg)) * osr], msg) for t, x, msg in zip(times, iq, msgs)]
@@ -0,0 +1,291 @@
+# sample sources for adsb_read.py
+#
+# Every source delivers complex64 samples scaled to [-1, 1) in blocks of
+# block_size samples through read(out), which fills out and returns the number
+# of samples written (0 at the end of the input). Radios are live: they keep
+# streaming whether or not the decoder is keeping up. Sources of unsigned 8
+# bit IQ pairs (amp_lut) can also look the amplitudes up from the raw bytes,
+# read(out, amp).
+
+import numpy as np
+import os
+import sys
+import time
+from adsb_dsp import iq_to_complex, uint8_amp_lut
+from adsb_synth import synth_signal
+
+modes_frequency = 1090e6
+
+
+class SampleSource(object):
+    live = False            # True if samples are lost when not read in time
+    nsamples = None         # length of the input if known
+    overflows = 0           # overruns reported by the radio
+    dropped_samples = 0     # samples the radio lost in those overruns
+    amp_lut = False         # True if read can fill in amplitudes from the raw bytes
+    mtime_ns = None         # modification time of a capture file, when it ended
+
+    def __init__(self, block_size):
+        super(SampleSource, self).__init__()
+        self.block_size = block_size
+
+    def read(self, out):
+        raise NotImplementedError
+
+    # position the input at absolute sample index pos (files only)
+    def seek(self, pos):
+        raise NotImplementedError("{} cannot seek".format(type(self).__name__))
+
+    def close(self):
+        pass
+
+
+# Analog Devices ADALM Pluto via pyadi-iio
+class PlutoSource(SampleSource):
+    live = True
+
+    def __init__(self, block_size, sampling_rate, device=None):
+        super(PlutoSource, self).__init__(block_size)
+        import adi
+
+        self.sdr = adi.Pluto(device or 'ip:pluto.local')
+        print("sample rate: {}".format(sampling_rate))
+        self.sdr.sample_rate = int(sampling_rate)
+        self.sdr.rx_rf_bandwidth = int(sampling_rate)
+        self.sdr.rx_lo = int(modes_frequency)
+        self.sdr.rx_buffer_size = int(block_size)
+        self.sdr.gain_control_mode_chan0 = "fast_attack"
+
+    def read(self, out):
+        cdata = self.sdr.rx() / 256
+        out[:len(cdata)] = cdata
+        return len(cdata)
+
+
+# Ettus USRP (B210) via the UHD python API. The radio is set up once and
+# streams continuously straight into the caller's blocks, rather than
+# recv_num_samps re-tuning and creating a new streamer for every block. UHD
+# restarts the stream by itself after an overflow ('O'); the overflows and
+# the samples lost, worked out from the packet timestamps, are counted. Each
+# receive timeout prints a 'T', and after max_timeouts in a row (a radio
+# unplugged or stalled) read raises an IOError rather than wait forever.
+class UHDSource(SampleSource):
+    live = True
+
+    def __init__(self, block_size, sampling_rate, device=None, gain=73, timeout=1.0,
+                 max_timeouts=10):
+        super(UHDSource, self).__init__(block_size)
+        import uhd
+
+        self.uhd = uhd
+        self.sampling_rate = sampling_rate
+        self.timeout = timeout
+        self.max_timeouts = max_timeouts
+        self.usrp = uhd.usrp.MultiUSRP(device or "type=b200")
+        self.usrp.set_rx_rate(sampling_rate, 0)
+        self.usrp.set_rx_freq(uhd.types.TuneRequest(modes_frequency), 0)
+        self.usrp.set_rx_gain(gain, 0)
+
+        st_args = uhd.usrp.StreamArgs("fc32", "sc16")
+        st_args.channels = [0]
+        self.streamer = self.usrp.get_rx_stream(st_args)
+        self.metadata = uhd.types.RXMetadata()
+        self.next_time = None       # expected timestamp of the next packet
+        self.timeouts = 0
+        self.timeouts_in_row = 0
+
+        stream_cmd = uhd.types.StreamCMD(uhd.types.StreamMode.start_cont)
+        stream_cmd.stream_now = True
+        self.streamer.issue_stream_cmd(stream_cmd)
+
+    def read(self, out):
+        errors = self.uhd.types.RXMetadataErrorCode
+        n = 0
+        while n < len(out):
+            samps = self.streamer.recv(out[n:].reshape(1, -1), self.metadata, self.timeout)
+            md = self.metadata
+            if md.error_code == errors.overflow:
+                self.overflows += 1
+                print('O', end='', file=sys.stderr, flush=True)
+            elif md.error_code == errors.timeout:
+                self.timeouts += 1
+                self.timeouts_in_row += 1
+                print('T', end='', file=sys.stderr, flush=True)
+                if self.timeouts_in_row >= self.max_timeouts:
+                    raise IOError("no samples from the USRP for {} receive timeouts of {} s".format(
+                                  self.timeouts_in_row, self.timeout))
+                continue
+            elif md.error_code != errors.none:
+                print(md.strerror(), file=sys.stderr, flush=True)
+
+            if samps > 0:
+                self.timeouts_in_row = 0
+            if md.has_time_spec and samps > 0:
+                t = md.time_spec.get_real_secs()
+                if self.next_time is not None:
+                    self.dropped_samples += max(0, int(round((t - self.next_time) * self.sampling_rate)))
+                self.next_time = t + samps / self.sampling_rate
+            n += samps
+
+        out *= 32
+        return n
+
+    def close(self):
+        self.streamer.issue_stream_cmd(self.uhd.types.StreamCMD(self.uhd.types.StreamMode.stop_cont))
+
+
+# converts uint8 IQ pairs into out and, if amp is given, looks their
+# amplitudes up into amp; returns the number of samples
+def _convert(iqdata, out, amp=None):
+    n = len(iq_to_complex(iqdata, out))
+    if amp is not None:
+        np.take(uint8_amp_lut(), iqdata[:2 * n].view('<u2'), out=amp[:n])
+    return n
+
+
+# unsigned 8 bit IQ pairs from a file, or from stdin ('-') as produced by
+# rtl_sdr and rx_sdr
+class FileSource(SampleSource):
+    amp_lut = True
+
+    def __init__(self, block_size, fname):
+        super(FileSource, self).__init__(block_size)
+        if fname == '-':
+            self.fd = open(0, 'rb')
+        else:
+            self.fd = open(fname, 'rb')
+            self.nsamples = os.path.getsize(fname) // 2
+            self.mtime_ns = os.stat(fname).st_mtime_ns
+
+    def read(self, out, amp=None):
+        iqdata = np.frombuffer(self.fd.read(2 * min(len(out), self.block_size)), dtype=np.uint8)
+        return _convert(iqdata, out, amp)
+
+    def seek(self, pos):
+        self.fd.seek(2 * pos)
+
+    def close(self):
+        self.fd.close()
+
+
+# unsigned 8 bit IQ pairs from a memory-mapped file, converted straight from
+# the mapping into the caller's block
+class MmapSource(SampleSource):
+    amp_lut = True
+
+    def __init__(self, block_size, fname):
+        super(MmapSource, self).__init__(block_size)
+        st = os.stat(fname)
+        # an empty file cannot be mapped, and has no samples to read
+        if st.st_size == 0:
+            self.iqmap = np.zeros(0, dtype=np.uint8)
+        else:
+            self.iqmap = np.memmap(fname, dtype=np.uint8, mode='r')
+        self.nsamples = len(self.iqmap) // 2
+        self.mtime_ns = st.st_mtime_ns
+        self.pos = 0
+
+    def read(self, out, amp=None):
+        n = min(len(out), self.block_size)
+        iqdata = self.iqmap[2 * self.pos:2 * (self.pos + n)]
+        self.pos += len(iqdata) // 2
+        return _convert(iqdata, out, amp)
+
+    def seek(self, pos):
+        self.pos = pos
+
+
+# a period seconds long capture from adsb_synth.synth_signal (random frames
+# from a few aircraft at rate per second, snr dB above Gaussian noise)
+# played in a loop for seconds, for trying the decoder without a radio or a
+# capture. Frames never cross the end of the period, so the loop has no
+# partial frames.
+class SyntheticSource(SampleSource):
+    def __init__(self, block_size, sampling_rate, osr, seconds=10, period=1.0,
+                 rate=1000, snr=(20, 30), noise=0.02, seed=0):
+        super(SyntheticSource, self).__init__(block_size)
+        self.nsamples = int(seconds * sampling_rate)
+        self.cdata, self.truth = synth_signal(int(period * sampling_rate), osr,
+                                              np.random.default_rng(seed), rate=rate, snr=snr,
+                                              noise=noise)
+        self.pos = 0
+
+    def read(self, out):
+        n = max(0, min(len(out), self.block_size, self.nsamples - self.pos))
+        # the window of the looped signal covering this block
+        done = 0
+        while done < n:
+            start = (self.pos + done) % len(self.cdata)
+            k = min(n - done, len(self.cdata) - start)
+            out[done:done + k] = self.cdata[start:start + k]
+            done += k
+        self.pos += n
+        return n
+
+    def seek(self, pos):
+        self.pos = pos
+
+
+# Receive times of samples: maps absolute sample indices (at sample_rate)
+# to int64 ns since the epoch. Sample 0 is placed either at a given time
+# (e.g. a capture file's end minus its length) or with start(), just before
+# the first block is handed over. The wall clock is read once and then only
+# followed through the monotonic clock, so a step of the system time during
+# a capture does not move the samples. Samples lost in overflows are
+# accounted for with skip(), each index being timed from the last skip
+# before it.
+class SampleClock(object):
+    def __init__(self, sample_rate, t0=None):
+        super(SampleClock, self).__init__()
+        self.sample_rate = sample_rate
+        self.wall0 = time.time_ns()
+        self.mono0 = time.monotonic_ns()
+        self.indices = []           # sample index and time (ns) of each skip
+        self.times = []
+        if t0 is not None:
+            self.set_start(t0)
+
+    @property
+    def started(self):
+        return len(self.times) > 0
+
+    # wall clock time (ns) followed through the monotonic clock
+    def now(self):
+        return self.wall0 + time.monotonic_ns() - self.mono0
+
+    def set_start(self, t0):
+        self.indices = [0]
+        self.times = [int(t0)]
+
+    # sample 0 taken nsamples sample periods before now
+    def start(self, nsamples=0):
+        self.set_start(self.now() - round(nsamples * 1e9 / self.sample_rate))
+
+    # nsamples lost just before sample index
+    def skip(self, index, nsamples):
+        t = self(index) + round(nsamples * 1e9 / self.sample_rate)
+        self.indices.append(int(index))
+        self.times.append(t)
+
+    # time (ns) of the sample at index, or of an array of indices
+    def __call__(self, index):
+        k = np.searchsorted(self.indices, index, side='right') - 1
+        t = np.asarray(self.times, dtype=np.int64)[k] + np.rint(
+            (np.asarray(index, dtype=np.int64) - np.asarray(self.indices, dtype=np.int64)[k])
+            * (1e9 / self.sample_rate)).astype(np.int64)
+        return int(t) if np.ndim(index) == 0 else t
+
+
+# create the source selected on the command line
+def open_source(args, block_size, sampling_rate):
+    source = args.source
+    if source == 'pluto':
+        return PlutoSource(block_size, sampling_rate, args.device)
+    elif source == 'uhd':
+        return UHDSource(block_size, sampling_rate, args.device, args.gain)
+    elif source == 'synthetic':
+        return SyntheticSource(block_size, sampling_rate, args.osr)
+    elif args.mmap:
+        return MmapSource(block_size, args.ifile)
+    else:
+        return FileSource(block_size, args.ifile)
@@ -0,0 +1,144 @@
+#!/usr/bin/python3
+
+# synthetic Mode S captures for testing and benchmarking the decoders
+#
+# Frames with valid parity (DF11/DF17 with the address in the message,
+# DF4/5/20/21 with the address overlaid on the parity) are built from a mix
+# of downlink formats and addresses, turned into waveforms with msg2bin and
+# added to complex Gaussian noise at a random SNR and carrier phase. The
+# arrival times are random at a given mean frame rate, and a fraction of the
+# frames can be made to overlap the one before. A carrier frequency offset
+# and a random walk phase noise can be applied to the whole capture. The
+# samples are written as unsigned 8 bit IQ pairs (what adsb_read.py reads)
+# or complex64, with the truth (sample index and message of every frame) in
+# a text file alongside.
+
+import numpy as np
+from adsb_dsp import msg2bin
+from adsb_crc import crc24, hex2packed
+
+# downlink formats and their share of the frames
+default_df_mix = {17: 0.4, 11: 0.2, 4: 0.1, 5: 0.1, 20: 0.1, 21: 0.1}
+
+
+# Returns a hex message of downlink format df from aircraft icao with random
+# contents and a correct parity field
+def make_msg(df, icao, rng):
+    nbytes = 14 if df in [16, 17, 18, 19, 20, 21, 24] else 7
+    b = bytearray(rng.integers(0, 256, nbytes, dtype=np.uint8).tobytes())
+    b[0] = (df << 3) | (b[0] & 7)
+    if df in [11, 17, 18]:
+        b[1:4] = icao.to_bytes(3, 'big')
+    b[-3:] = bytes(3)
+    msg = b.hex().upper()
+    parity = int(crc24(hex2packed([msg])[0], 8 * nbytes)[0])
+    if df not in [11, 17, 18]:
+        parity ^= icao
+    b[-3:] = parity.to_bytes(3, 'big')
+    return b.hex().upper()
+
+
+# Returns (cdata, truth): nsamples complex64 samples at 2 MHz * osr with
+# frames arriving at rate per second on average, truth a list of (sample
+# index, message) in sample order. snr is the (min, max) SNR in dB of the
+# frames (pulse power over noise power), overlap the fraction of frames
+# starting inside the previous one, cfo the carrier frequency offset in Hz
+# and phase_noise the standard deviation (radians) of the per sample step of
+# the carrier phase.
+def synth_signal(nsamples, osr, rng, rate=1000, df_mix=None, snr=(10, 30), naircraft=20,
+                 overlap=0.0, cfo=0.0, phase_noise=0.0, noise=0.02):
+    df_mix = default_df_mix if df_mix is None else df_mix
+    sample_rate = 2e6 * osr
+    dfs = list(df_mix)
+    p = np.array([df_mix[df] for df in dfs], dtype=float)
+    p /= p.sum()
+    icaos = [int(a) for a in rng.integers(0, 1 << 24, naircraft)]
+
+    cdata = (rng.normal(0, noise, nsamples) + 1j * rng.normal(0, noise, nsamples)).astype(np.complex64)
+    truth = []
+    pos = 0
+    prev_len = 0
+    while True:
+        if truth and rng.random() < overlap:
+            pos = truth[-1][0] + int(rng.integers(1, prev_len))
+        else:
+            gap = int(rng.exponential(sample_rate / rate)) if rate > 0 else nsamples
+            pos += prev_len + gap
+        msg = make_msg(int(rng.choice(dfs, p=p)), icaos[rng.integers(len(icaos))], rng)
+        wave = msg2bin(msg, osr)
+        if pos + len(wave) > nsamples:
+            break
+        amp = np.sqrt(2) * noise * 10 ** (rng.uniform(*snr) / 20)
+        cdata[pos:pos + len(wave)] += amp * np.exp(1j * rng.uniform(0, 2 * np.pi)) * wave
+        truth.append((pos, msg))
+        prev_len = len(wave)
+
+    if cfo != 0 or phase_noise > 0:
+        phase = 2 * np.pi * cfo / sample_rate * np.arange(nsamples)
+        if phase_noise > 0:
+            phase += np.cumsum(rng.normal(0, phase_noise, nsamples))
+        cdata *= np.exp(1j * phase).astype(np.complex64)
+    truth.sort()
+    return cdata, truth
+
+
+# writes cdata as uint8 IQ pairs (as rtl_sdr, clipped to [-1, 1)) or as
+# complex64, and truth to fname.msgs
+def write_capture(fname, cdata, truth, fmt='uint8'):
+    if fmt == 'uint8':
+        iq = cdata.view(np.float32) * 128 + 127
+        np.clip(np.rint(iq), 0, 255).astype(np.uint8).tofile(fname)
+    else:
+        cdata.astype(np.complex64).tofile(fname)
+    with open(fname + '.msgs', 'w') as fd:
+        for pos, msg in truth:
+            fd.write('{} {}\n'.format(pos, msg))
+
+
+# reads the truth file written by write_capture
+def read_truth(fname):
+    with open(fname + '.msgs') as fd:
+        return [(int(pos), msg) for pos, msg in (line.split() for line in fd)]
+
+
+# parses a DF mix such as "17:4,11:2,20:1"
+def parse_df_mix(text):
+    return {int(df): float(w) for df, w in (item.split(':') for item in text.split(','))}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--ofile', action='store', required=True,
+                        help='Output file name (the truth goes to OFILE.msgs)')
+    parser.add_argument('-r', '--osr', type=int, default=1,
+                        help='Oversampling ratio')
+    parser.add_argument('-s', '--seconds', type=float, default=1.0,
+                        help='Length of the capture (s)')
+    parser.add_argument('-R', '--rate', type=float, default=1000,
+                        help='Mean number of frames per second')
+    parser.add_argument('-m', '--mix', type=parse_df_mix, default=None,
+                        help='Downlink format mix, e.g. 17:4,11:2,4:1 (default: mostly DF17 and DF11)')
+    parser.add_argument('-n', '--snr', type=float, nargs=2, default=[10, 30],
+                        help='Range of the frame SNRs (dB)')
+    parser.add_argument('-a', '--aircraft', type=int, default=20,
+                        help='Number of ICAO addresses')
+    parser.add_argument('--overlap', type=float, default=0.0,
+                        help='Fraction of frames starting inside the previous frame')
+    parser.add_argument('--cfo', type=float, default=0.0,
+                        help='Carrier frequency offset (Hz)')
+    parser.add_argument('--phase-noise', type=float, default=0.0,
+                        help='Standard deviation of the per sample phase step (rad)')
+    parser.add_argument('-f', '--format', choices=['uint8', 'complex64'], default='uint8',
+                        help='Sample format of the output file')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    cdata, truth = synth_signal(int(args.seconds * 2e6 * args.osr), args.osr, rng, args.rate,
+                                args.mix, args.snr, args.aircraft, args.overlap, args.cfo,
+                                args.phase_noise)
+    write_capture(args.ofile, cdata, truth, args.format)
+    print("{} frames written to {}".format(len(truth), args.ofile))
@@ -1,11 +1,15 @@
-import time
 import math
 import numpy as np
 import pyModeS as pms
 import sys
-from datetime import datetime
-import scipy.signal as sig
-import statistics as stats
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from adsb_dsp import pbits, preamble, th_amp_diff, demod_frames, frames2hex, replicate, msg2bin
+from adsb_crc import check_frames
+
+# reasons given by ADSBwave.verify_batch, indexed by its reason codes
+verify_reasons = ['ok', 'no preamble', 'early stop', 'crc', 'mismatch']
 
 def eng_string( x, format='%s', si=False):
     '''
@@ -43,29 +47,11 @@ def eng_string( x, format='%s', si=False):
 
     return ( '%s'+format+'%s') % ( sign, x3, exp3_text)
 
-# Returns a np.array with each element of _r replicated times times
-def replicate(a, c):
-    r = []
-    for x in a:
-        r.extend([x] * c)
-    return np.array(r)
-
-# generates the code for a message
-def msg2bin(msg, osr):
-    ex_msg = "".join(['10' if x == '1' else '01' for x in pms.hex2bin(msg)])
-    ex_preamble = "".join(['1' if x == 1 else '0' for x in preamble])
-    ex_full = [1 if x == '1' else 0 for x in (ex_preamble + ex_msg)]
-    return replicate(ex_full, osr)
-
-pbits = 8
-fbits = 112
-preamble = [1, 0, 1, 0, 0, 0, 0, 1, 0, 1, 0, 0, 0, 0, 0, 0]
-th_amp_diff = 0.8   # signal amplitude threshold difference between 0 and 1 bit
-
 class ADSBwave(object):
-    def __init__(self, osr=1, verbose=0, lfp=None):
+    def __init__(self, osr=1, verbose=0, lfp=None, fix=1):
         super(ADSBwave, self).__init__()
         self.osr = osr                 # oversampling ratio
+        self.fix = fix                 # bit errors corrected in DF11/DF17
         self.verbose = verbose         # verbose mode 1=print decoded squitter, 2=stats, 3=plot
         self.debug = 0         
         self.preamble = replicate(preamble, self.osr)
@@ -81,6 +67,56 @@ class ADSBwave(object):
     def verify(self, cdata, xmsg):
         return self.decode(cdata) == xmsg
 
+    # Verifies a batch of records: cdata is an (N, window) complex array of
+    # windows starting at the preamble, xmsgs the N expected hex messages and
+    # lengths (optional) the number of valid samples of each row, the rest
+    # being padding. Gives the same answers as verify on each row but the
+    # preamble check, demodulation and parity check are each done once for
+    # the batch. Returns (mask, reasons) with reasons the index in
+    # verify_reasons of why each record failed (0 if it verified).
+    def verify_batch(self, cdata, xmsgs, lengths=None):
+        cdata = np.asarray(cdata)
+        nrec, window = cdata.shape
+        osr = self.osr
+        lengths = np.full(nrec, window) if lengths is None else np.asarray(lengths)
+        reasons = np.zeros(nrec, dtype=np.int8)
+        if nrec == 0:
+            return reasons == 0, reasons
+
+        # rows one bit longer than the window and -inf past each length (as
+        # demod_frames pads), so a frame stops at the end of its row as it
+        # does at the end of a lone window
+        stride = window + 2 * osr
+        amp = np.full((nrec, stride), -np.inf, dtype=np.float32)
+        np.absolute(cdata, out=amp[:, :window])
+        amp[np.arange(stride) >= lengths[:, None]] = -np.inf
+
+        # NaNs pass the preamble check, as in _check_preamble
+        has_preamble = ~(np.abs(amp[:, :self.preamble_len] - self.preamble) > th_amp_diff).any(axis=1)
+        has_preamble &= lengths >= self.preamble_len
+        reasons[~has_preamble] = 1
+
+        rows = np.flatnonzero(has_preamble)
+        packed, nbits, stop = demod_frames(amp.ravel(), rows * stride, osr)
+        # frames cut short of a whole message; any other length fails the
+        # parity check
+        early = (nbits < 112) & (nbits != 56)
+        reasons[rows[early]] = 2
+
+        rows = rows[~early]
+        checked = check_frames(frames2hex(packed[~early], nbits[~early]), self.fix)
+        expected = [xmsgs[r] for r in rows.tolist()]
+        reasons[rows[[msg is None for msg, addr, df in checked]]] = 3
+        reasons[rows[[msg is not None and msg != x for (msg, addr, df), x in zip(checked, expected)]]] = 4
+
+        mask = reasons == 0
+        if self.verbose > 0:
+            for code in range(1, len(verify_reasons)):
+                n = int((reasons == code).sum())
+                if n > 0:
+                    self._print('Verify: {} records failed: {}'.format(n, verify_reasons[code]))
+        return mask, reasons
+
     def decode(self, cdata):
         """process raw IQ data in the buffer"""
 
@@ -90,37 +126,16 @@ class ADSBwave(object):
         # oversampling rate is the rate above the minimum 2 MHz one
         osr = self.osr
 
+        msghex = None
         signal_buffer = np.absolute(cdata)
         if self._check_preamble(signal_buffer[0:pbits * 2 * osr]):
-            frame_start = pbits * 2 * osr
-            frame_end = (pbits + (fbits + 1)) * 2 * osr
-            frame_length = (fbits + 1) * 2 * osr
-            frame_pulses = signal_buffer[frame_start:frame_end]
-
-            threshold = max(frame_pulses) * 0.2
-
-            msgbin = []
-            for j in range(0, frame_length, 2 * osr):
-                p2 = frame_pulses[j : j + 2 * osr]
-                if len(p2) < 2 * osr:
-                    break
-
-                if p2[0] < threshold and p2[osr] < threshold:
-                    break
-                elif p2[0] >= p2[osr]:
-                    c = 1
-                elif p2[0] < p2[osr]:
-                    c = 0
-                else:
-                    msgbin = []
-                    break
-
-                msgbin.append(c)
+            packed, nbits, stop = demod_frames(signal_buffer, [0], osr)
+            msghex = frames2hex(packed, nbits)[0]
 
-            if len(msgbin) > 0:
-                msghex = pms.bin2hex("".join([str(i) for i in msgbin]))
+            if msghex is not None:
                 # self._debug_msg(msghex)
-                if self._check_msg(msghex):     # we have a good message
+                msghex = self._check_msg(msghex)
+                if msghex is not None:          # we have a good (maybe corrected) message
                     self._good_msg(msghex, cdata)
                 else:
                     if self.verbose > 0:
@@ -143,18 +158,9 @@ class ADSBwave(object):
 
         return True
 
+    # returns the message, corrected if needed, or None if it fails the parity check
     def _check_msg(self, msg):
-        df = pms.df(msg)
-        msglen = len(msg)
-        if df == 17 and msglen == 28:
-            if pms.crc(msg) == 0:
-                return True
-        elif df in [20, 21] and msglen == 28:
-            return True
-        elif df in [4, 5, 11] and msglen == 14:
-            return True
-
-        return False
+        return check_frames([msg], self.fix)[0][0]
         
     def _good_msg(self, msg, iq_window):
         # iq_window are our raw samples find the best alignment
@@ -177,8 +183,10 @@ class ADSBwave(object):
             plt.show()
 
     def _debug_msg(self, msg):
-        df = pms.df(msg)
-        if self._check_msg(msg):
+        good = self._check_msg(msg)
+        if good is not None:
+            msg = good
+            df = pms.df(msg)
             msglen = len(msg)
             if df == 17 and msglen == 28:
                 print(msg, pms.icao(msg), pms.crc(msg))
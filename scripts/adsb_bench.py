@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+
+# decoder benchmark on synthetic captures (see adsb_synth.py)
+#
+# A capture is generated from a fixed seed, written as uint8 IQ and decoded
+# with SDRFileReader (as adsb_read.py -i would) and frame by frame with
+# ADSBwave.decode. For each decoder the throughput (Msamples/s, frames/s),
+# the detection probability (fraction of the frames sent that are decoded)
+# and the false-accept rate (fraction of the messages decoded that were not
+# sent) are reported. The --min/--max options make it fail (exit status 1)
+# when a decoder gets slower or worse, so it can gate changes.
+
+import argparse
+import collections
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import adsb_read
+from adsb_dsp import pbits, fbits, iq_to_complex
+from adsb_synth import synth_signal, write_capture, parse_df_mix
+from ADSBwave import ADSBwave
+
+
+# (detection probability, false-accept rate) of the decoded messages
+# against the messages sent, counting repeated messages
+def score(sent, decoded):
+    hits = sum((collections.Counter(sent) & collections.Counter(decoded)).values())
+    pd = hits / len(sent) if sent else 0.0
+    far = (len(decoded) - hits) / len(decoded) if decoded else 0.0
+    return pd, far
+
+
+def bench_reader(fname, osr, truth, extra_args):
+    args = adsb_read.parse_args(['-i', fname, '-r', str(osr)] + extra_args)
+    reader = adsb_read.SDRFileReader(args=args)
+    msgs = []
+    reader.handle_messages = lambda messages: msgs.extend(m[0] for m in messages)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        if args.workers > 1:
+            reader.run_workers(args.workers)
+        else:
+            reader.run()
+        elapsed = time.perf_counter() - t0
+
+    # only whole buffers are decoded, frames in the tail are not expected
+    frame_len = (pbits + fbits + 1) * 2 * osr
+    sent = [m for pos, m in truth if pos + frame_len <= reader.buffer_end]
+    pd, far = score(sent, msgs)
+    return {'decoder': 'SDRFileReader', 'seconds': elapsed,
+            'msamples_per_s': reader.metrics.counters.get('samples_in', 0) / elapsed / 1e6,
+            'frames_per_s': len(msgs) / elapsed, 'frames': len(sent), 'pd': pd, 'far': far}
+
+
+def bench_wave(cdata, osr, truth):
+    wave = ADSBwave(osr=osr)
+    frame_len = (pbits + fbits + 1) * 2 * osr
+    sent = [(pos, m) for pos, m in truth if pos + frame_len <= len(cdata)]
+    msgs = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        for pos, m in sent:
+            msg = wave.decode(cdata[pos:pos + frame_len])
+            if msg is not None:
+                msgs.append(msg)
+        elapsed = time.perf_counter() - t0
+
+    pd, far = score([m for pos, m in sent], msgs)
+    return {'decoder': 'ADSBwave', 'seconds': elapsed,
+            'msamples_per_s': len(sent) * frame_len / elapsed / 1e6,
+            'frames_per_s': len(sent) / elapsed, 'frames': len(sent), 'pd': pd, 'far': far}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', '--osr', type=int, default=1, help='Oversampling ratio')
+    parser.add_argument('-s', '--seconds', type=float, default=2.0,
+                        help='Length of the capture (s), rounded up to whole decoder buffers')
+    parser.add_argument('-R', '--rate', type=float, default=1000, help='Mean number of frames per second')
+    parser.add_argument('-m', '--mix', type=parse_df_mix, default=None,
+                        help='Downlink format mix, e.g. 17:4,11:2,4:1')
+    parser.add_argument('-n', '--snr', type=float, nargs=2, default=[20, 30],
+                        help='Range of the frame SNRs (dB)')
+    parser.add_argument('--overlap', type=float, default=0.0,
+                        help='Fraction of frames starting inside the previous frame')
+    parser.add_argument('--cfo', type=float, default=0.0, help='Carrier frequency offset (Hz)')
+    parser.add_argument('--phase-noise', type=float, default=0.0,
+                        help='Standard deviation of the per sample phase step (rad)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('-k', '--keep', action='store', default=None,
+                        help='Keep the capture in this file (and its truth in KEEP.msgs)')
+    parser.add_argument('-j', '--json', action='store', default=None,
+                        help='Also write the results to this file as JSON')
+    parser.add_argument('--reader-args', action='store', default='',
+                        help='Extra adsb_read.py options for SDRFileReader, e.g. "-w 4"')
+    parser.add_argument('--min-msps', type=float, default=None,
+                        help='Fail if SDRFileReader decodes fewer Msamples/s')
+    parser.add_argument('--min-pd', type=float, default=None,
+                        help='Fail if a decoder detects a smaller fraction of the frames')
+    parser.add_argument('--max-far', type=float, default=None,
+                        help='Fail if a decoder has a larger false-accept rate')
+    cargs = parser.parse_args()
+
+    rng = np.random.default_rng(cargs.seed)
+    # SDRFileReader only decodes whole buffers (of 2048000 * osr samples)
+    buffer_size = 1024 * 2000 * cargs.osr
+    nsamples = -(-int(cargs.seconds * 2e6 * cargs.osr) // buffer_size) * buffer_size
+    cdata, truth = synth_signal(nsamples, cargs.osr, rng, cargs.rate, cargs.mix, cargs.snr,
+                                overlap=cargs.overlap, cfo=cargs.cfo, phase_noise=cargs.phase_noise)
+
+    fname = cargs.keep
+    if fname is None:
+        fd, fname = tempfile.mkstemp(suffix='.raw')
+        os.close(fd)
+    try:
+        write_capture(fname, cdata, truth)
+        # both decoders get the quantised samples
+        cdata = iq_to_complex(np.fromfile(fname, dtype=np.uint8))
+        results = [bench_reader(fname, cargs.osr, truth, cargs.reader_args.split()),
+                   bench_wave(cdata, cargs.osr, truth)]
+    finally:
+        if cargs.keep is None:
+            os.remove(fname)
+            os.remove(fname + '.msgs')
+
+    print("{:14s} {:>8s} {:>10s} {:>10s} {:>7s} {:>7s} {:>7s}".format(
+          'decoder', 'seconds', 'Msamples/s', 'frames/s', 'frames', 'Pd', 'FAR'))
+    for r in results:
+        print("{decoder:14s} {seconds:8.3f} {msamples_per_s:10.2f} {frames_per_s:10.1f} "
+              "{frames:7d} {pd:7.4f} {far:7.4f}".format(**r))
+    if cargs.json is not None:
+        with open(cargs.json, 'w') as fd:
+            json.dump({'args': vars(cargs), 'results': results}, fd, indent=2, default=str)
+
+    failed = []
+    if cargs.min_msps is not None and results[0]['msamples_per_s'] < cargs.min_msps:
+        failed.append('SDRFileReader Msamples/s below {}'.format(cargs.min_msps))
+    for r in results:
+        if cargs.min_pd is not None and r['pd'] < cargs.min_pd:
+            failed.append('{} Pd below {}'.format(r['decoder'], cargs.min_pd))
+        if cargs.max_far is not None and r['far'] > cargs.max_far:
+            failed.append('{} FAR above {}'.format(r['decoder'], cargs.max_far))
+    for f in failed:
+        print("FAIL:", f)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,292 @@
+#!/usr/bin/python3
+
+# regression corpus of decoder outputs for reference captures
+#
+#   adsb_corpus.py record -c CORPUS [--reader-args="adsb_read options"] [-n TAG] captures...
+#   adsb_corpus.py compare -c CORPUS [--reader-args="adsb_read options"] [-n TAG] [--strict]
+#   adsb_corpus.py baseline -c CORPUS -b REV [--reader-args="adsb_read options"] captures...
+#
+# record decodes each capture with SDRFileReader and keeps, in
+# CORPUS/<capture name>[-TAG]/, the decoded (sample index, message) list,
+# the decoding time in golden.json and the training records written. compare
+# decodes every capture of the corpus again with the current code and the
+# options recorded with it (plus any given with -a) and reports for each the
+# frames missed, the extra frames, the frames decoded at the same sample
+# with different bits, the golden training records not written again and
+# the change in throughput; with -n TAG only the entries recorded with
+# that tag are compared. It exits with status 1 if anything was missed or
+# differs (or, with --strict, if there are extra frames or the throughput
+# dropped by more than --max-slowdown), so a faster decoder is only
+# accepted when it finds the same frames or more.
+#
+# baseline instead records the output of the decoder of an older revision
+# REV of this repository (checked out with git archive), so a rewrite can be
+# held to the code it replaced rather than to itself. Older decoders give
+# no sample indices, so these entries keep the message and a digest of the
+# iq window of every training record, in order, and the CPU time of the
+# whole adsb_read.py run; compare runs the current adsb_read.py the same way
+# and counts a record as missed if its message or window is not reproduced.
+
+import argparse
+import collections
+import contextlib
+import glob
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import numpy as np
+
+topdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(topdir)
+import adsb_read
+from adsb_records import read_records, load_tdata
+
+# runs adsb_read.py (argv[2]) with options argv[3:] as a script and writes
+# the CPU time it took to argv[1], the modules it imports loaded beforehand
+_driver = """
+import os, sys, time, runpy
+import numpy, scipy.signal, pyModeS, matplotlib.pyplot
+timefile, script = sys.argv[1], os.path.abspath(sys.argv[2])
+sys.path.insert(0, os.path.dirname(script))
+sys.argv = [script] + sys.argv[3:]
+t0 = time.process_time()
+runpy.run_path(script, run_name='__main__')
+with open(timefile, 'w') as fd:
+    fd.write(repr(time.process_time() - t0))
+"""
+
+
+# decodes capture with adsb_read options reader_args, writing the training
+# records to tfile; returns (frames, seconds, samples) with frames the
+# [sample index, msg] of each frame decoded
+def decode(capture, reader_args, tfile):
+    args = adsb_read.parse_args(['-i', capture, '-t', tfile] + reader_args)
+    reader = adsb_read.SDRFileReader(args=args)
+    frames = []
+    reader.handle_messages = lambda messages: frames.extend([m[2], m[0]] for m in messages)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        if args.workers > 1:
+            reader.run_workers(args.workers)
+        else:
+            reader.run()
+        elapsed = time.perf_counter() - t0
+    return frames, elapsed, reader.metrics.counters.get('samples_in', 0)
+
+
+# runs the adsb_read.py of tree on capture with options reader_args;
+# returns (records, seconds) with records the [msg, iq digest] of each
+# training record written, in order, and seconds the CPU time
+def run_script(tree, capture, reader_args):
+    with tempfile.TemporaryDirectory() as tmp:
+        tfile = os.path.join(tmp, 't')
+        timefile = os.path.join(tmp, 'seconds')
+        subprocess.run([sys.executable, '-c', _driver, timefile, os.path.join(tree, 'adsb_read.py'),
+                        '-i', os.path.abspath(capture), '-t', tfile] + reader_args,
+                       cwd=tree, check=True, stdout=subprocess.DEVNULL)
+        with open(timefile) as fd:
+            seconds = float(fd.read())
+        fnames = glob.glob(tfile + '-*-tdata.bin')
+        fnames.sort(key=lambda f: int(re.search(r'-(\d+)-tdata\.bin$', f).group(1)))
+        records = [[msg, hashlib.sha1(np.asarray(d_in, dtype=np.complex64).tobytes()).hexdigest()[:16]]
+                   for f in fnames for dtime, d_in, msg in load_tdata(f)]
+    return records, seconds
+
+
+# all the training records written under the prefix tfile, in file order
+def load_records(tfile):
+    fnames = glob.glob(tfile + '-*-tdata.bin')
+    fnames.sort(key=lambda f: int(re.search(r'-(\d+)-tdata\.bin$', f).group(1)))
+    recs = [read_records(f, mmap=False)[1] for f in fnames]
+    return np.concatenate(recs) if recs else None
+
+
+# the records as hashable rows, timestamps and sample indices (compared as
+# frames, and missing from older records) left out and alignment rounded
+def _record_keys(rec):
+    if rec is None:
+        return []
+    fields = [name for name in rec.dtype.names if name not in ['timestamp', 'sample', 'align', 'corr']]
+    keys = [tuple(r[name].tobytes() for name in fields) for r in rec]
+    if 'align' in rec.dtype.names:
+        keys = [k + (round(float(a), 3), round(float(c), 3))
+                for k, a, c in zip(keys, rec['align'], rec['corr'])]
+    return keys
+
+
+# (number of golden records with no identical new record, number of new
+# records with no identical golden record), timestamps aside
+def diff_records(golden, new):
+    g = collections.Counter(_record_keys(golden))
+    n = collections.Counter(_record_keys(new))
+    return sum((g - n).values()), sum((n - g).values())
+
+
+# (missed, extra, bitdiff) between two lists of [sample index, msg]: frames
+# at the same index with different messages are bit differences, given as
+# (index, golden msg, new msg, number of bits)
+def diff_frames(golden, new):
+    g = {idx: msg for idx, msg in golden}
+    n = {idx: msg for idx, msg in new}
+    missed = [(idx, g[idx]) for idx in sorted(g.keys() - n.keys())]
+    extra = [(idx, n[idx]) for idx in sorted(n.keys() - g.keys())]
+    bitdiff = []
+    for idx in sorted(g.keys() & n.keys()):
+        a, b = g[idx], n[idx]
+        if a != b:
+            nbits = bin(int(a, 16) ^ int(b, 16)).count('1') if len(a) == len(b) else -1
+            bitdiff.append((idx, a, b, nbits))
+    return missed, extra, bitdiff
+
+
+def record(cargs):
+    for capture in cargs.captures:
+        name = os.path.splitext(os.path.basename(capture))[0]
+        if cargs.tag:
+            name += '-' + cargs.tag
+        entry = os.path.join(cargs.corpus, name)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        os.makedirs(entry)
+        reader_args = cargs.reader_args.split()
+        frames, elapsed, samples = decode(capture, reader_args, os.path.join(entry, 't'))
+        golden = {'capture': os.path.abspath(capture), 'reader_args': reader_args,
+                  'seconds': elapsed, 'samples': samples, 'frames': frames}
+        with open(os.path.join(entry, 'golden.json'), 'w') as fd:
+            json.dump(golden, fd)
+        print("{}: {} frames, {:.2f} Msamples/s".format(name, len(frames), samples / elapsed / 1e6))
+
+
+def baseline(cargs):
+    rev = subprocess.run(['git', 'rev-parse', cargs.baseline], cwd=topdir, check=True,
+                         capture_output=True, text=True).stdout.strip()
+    reader_args = cargs.reader_args.split()
+    with tempfile.TemporaryDirectory() as tree:
+        archive = subprocess.run(['git', 'archive', '--format=tar', rev], cwd=topdir, check=True,
+                                 capture_output=True).stdout
+        with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+            tar.extractall(tree)
+        for capture in cargs.captures:
+            name = os.path.splitext(os.path.basename(capture))[0]
+            if cargs.tag:
+                name += '-' + cargs.tag
+            entry = os.path.join(cargs.corpus, name)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.makedirs(entry)
+            records, seconds = run_script(tree, capture, reader_args)
+            golden = {'capture': os.path.relpath(capture, topdir), 'baseline': rev,
+                      'reader_args': reader_args, 'seconds': seconds, 'records': records}
+            with open(os.path.join(entry, 'golden.json'), 'w') as fd:
+                json.dump(golden, fd, indent=0)
+            print("{}: {} records, {:.2f} s CPU".format(name, len(records), seconds))
+
+
+# the (record number, msg) of the records of a whose message is not in b
+# (as many times)
+def _unmatched(a, b):
+    left = collections.Counter(msg for msg, digest in a) - collections.Counter(msg for msg, digest in b)
+    unmatched = []
+    for k, (msg, digest) in enumerate(a):
+        if left[msg] > 0:
+            left[msg] -= 1
+            unmatched.append((k, msg))
+    return unmatched
+
+
+# (missed, extra, records, new_records) between the golden records of a
+# baseline entry and the new ones: the messages missed and extra, as
+# (record number, msg), and the numbers of golden records (message and
+# window) not written again and of new records not in the golden ones
+def diff_baseline(golden, new):
+    g = collections.Counter(map(tuple, golden))
+    n = collections.Counter(map(tuple, new))
+    return _unmatched(golden, new), _unmatched(new, golden), sum((g - n).values()), sum((n - g).values())
+
+
+def compare(cargs):
+    failed = False
+    entries = sorted(glob.glob(os.path.join(cargs.corpus, '*' + ('-' + cargs.tag if cargs.tag else ''),
+                                            'golden.json')))
+    if not entries:
+        print("no golden outputs in", cargs.corpus)
+        return 1
+    print("{:20s} {:>7s} {:>7s} {:>7s} {:>7s} {:>7s} {:>10s}".format(
+          'capture', 'frames', 'missed', 'extra', 'bitdiff', 'records', 'throughput'))
+    for fname in entries:
+        entry = os.path.dirname(fname)
+        with open(fname) as fd:
+            golden = json.load(fd)
+        reader_args = golden['reader_args'] + cargs.reader_args.split()
+        if 'baseline' in golden:
+            # CPU time of the whole run on the same capture, see run_script
+            new, elapsed = run_script(topdir, os.path.join(topdir, golden['capture']), reader_args)
+            frames = [msg for msg, digest in new]
+            missed, extra, records, new_records = diff_baseline(golden['records'], new)
+            bitdiff = []
+            speedup = golden['seconds'] / elapsed - 1
+        else:
+            with tempfile.TemporaryDirectory() as tmp:
+                frames, elapsed, samples = decode(golden['capture'], reader_args, os.path.join(tmp, 't'))
+                records, new_records = diff_records(load_records(os.path.join(entry, 't')),
+                                             load_records(os.path.join(tmp, 't')))
+            missed, extra, bitdiff = diff_frames(golden['frames'], frames)
+            speedup = (samples / elapsed) / (golden['samples'] / golden['seconds']) - 1
+        print("{:20s} {:7d} {:7d} {:7d} {:7d} {:7d} {:+9.1f}%".format(
+              os.path.basename(entry), len(frames), len(missed), len(extra), len(bitdiff),
+              records, 100 * speedup))
+        if cargs.verbose:
+            for idx, msg in missed:
+                print("  missed ", idx, msg)
+            for idx, msg in extra:
+                print("  extra  ", idx, msg)
+            for idx, a, b, nbits in bitdiff:
+                print("  bitdiff", idx, a, b, nbits)
+        slower = speedup < -cargs.max_slowdown / 100
+        if cargs.verbose and cargs.strict and slower:
+            print("  throughput down by more than {}%".format(cargs.max_slowdown))
+        if missed or bitdiff or records or (cargs.strict and (extra or new_records or slower)):
+            failed = True
+    print("DIFFERENT" if failed else "SAME")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['record', 'compare', 'baseline'])
+    parser.add_argument('captures', nargs='*', help='Captures to add to the corpus (record, baseline)')
+    parser.add_argument('-c', '--corpus', action='store', required=True,
+                        help='Corpus directory')
+    parser.add_argument('-a', '--reader-args', action='store', default='',
+                        help='adsb_read.py options, e.g. --reader-args="-u4 -r4" '
+                             '(compare: added to those recorded)')
+    parser.add_argument('-n', '--tag', action='store', default=None,
+                        help='Suffix of the corpus entry names, to keep several runs of a capture '
+                             '(compare: only the entries with this suffix)')
+    parser.add_argument('-b', '--baseline', action='store', default=None,
+                        help='git revision whose decoder the baseline command records')
+    parser.add_argument('--strict', action='store_true',
+                        help='Also fail on extra frames or a drop in throughput')
+    parser.add_argument('--max-slowdown', type=float, default=15,
+                        help='Throughput drop (%%) tolerated with --strict')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='List the frames that differ')
+    cargs = parser.parse_intermixed_args()
+
+    if cargs.command == 'record':
+        record(cargs)
+    elif cargs.command == 'baseline':
+        if cargs.baseline is None:
+            parser.error('baseline needs a revision (-b)')
+        baseline(cargs)
+    else:
+        sys.exit(compare(cargs))
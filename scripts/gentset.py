@@ -7,8 +7,13 @@ import numpy as np
 import os, gc
 import re
 import math
+import json
+import hashlib
+import multiprocessing
+from collections import deque
 import pyModeS as pms
 from ADSBwave import *
+from adsb_records import load_tdata, is_h5_tdata, timestamps_ns
 
 cruxml_dnn_path = '../../CruxML_DNN'
 if os.path.isdir(cruxml_dnn_path):
@@ -165,10 +170,131 @@ def mytell(msg, lfp):
             _print("Pressure", commb.p45(msg), "hPa")
             _print("Radio height", commb.rh45(msg), "feet")
 
-# read and decode all .bin files in the directory, 
-def readdir(dir, lfp, verbose=0, osr=4, wave=None):
+# hash of the code that decides which records are valid, part of the
+# manifest key so the cache is thrown away when the verification changes
+def verify_code_version():
+    h = hashlib.sha1()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for fname in ['ADSBwave.py', '../adsb_dsp.py', '../adsb_crc.py', '../adsb_records.py']:
+        with open(os.path.join(here, fname), 'rb') as fd:
+            h.update(fd.read())
+    return h.hexdigest()
+
+
+# ADSBwave used by each FileVerifier process
+_wave = None
+
+def _init_verifier(osr):
+    global _wave
+    _wave = ADSBwave(osr=osr, lfp=open(os.devnull, 'w'))
+
+# indices of the records of fname that verify, the number of records and
+# the valid records themselves, so the file is only loaded once. The records
+# are verified batch records at a time, their windows (which differ in
+# length with the message length) stacked and zero padded.
+def _verify_file(fname, wave=None, batch=4096):
+    wave = _wave if wave is None else wave
+    data = load_tdata(fname)
+    valid = []
+    for lo in range(0, len(data), batch):
+        chunk = data[lo:lo + batch]
+        lengths = np.array([len(d_in) for dtime, d_in, d_out in chunk])
+        cdata = np.zeros((len(chunk), lengths.max()), dtype=np.complex64)
+        for k, (dtime, d_in, d_out) in enumerate(chunk):
+            cdata[k, :len(d_in)] = d_in
+        mask, reasons = wave.verify_batch(cdata, [d_out for dtime, d_in, d_out in chunk], lengths)
+        valid.extend((lo + np.flatnonzero(mask)).tolist())
+    return valid, len(data), [data[k] for k in valid]
+
+
+class FileVerifier(object):
+    """verifies the records of training files, with a pool of jobs processes
+    if jobs > 1, keeping the indices of the valid records of each file in a
+    JSON manifest so files already seen with the same size, modification
+    time, osr and verification code are not verified again"""
+
+    def __init__(self, osr, jobs=1, manifest=None, wave=None):
+        super(FileVerifier, self).__init__()
+        self.osr = osr
+        self.jobs = jobs
+        self.wave = ADSBwave(osr=osr) if wave is None else wave
+        self.pool = multiprocessing.Pool(jobs, _init_verifier, (osr,)) if jobs > 1 else None
+        self.manifest = manifest
+        self.code = verify_code_version()
+        self.files = {}
+        self.hits = 0
+        if manifest and os.path.isfile(manifest):
+            with open(manifest) as fd:
+                self.files = json.load(fd).get('files', {})
+
+    def _key(self, fname):
+        st = os.stat(fname)
+        return {'size': st.st_size, 'mtime': st.st_mtime_ns, 'osr': self.osr, 'code': self.code}
+
+    # True if the manifest holds the results for fname with key
+    def _cached(self, fname, key):
+        entry = self.files.get(os.path.abspath(fname))
+        return entry is not None and all(entry.get(k) == v for k, v in key.items())
+
+    # returns an iterator over (fname, valid, nrecords, records) for fnames,
+    # in order, records being the valid records of the files just verified
+    # and None for those taken from the manifest (not loaded yet)
+    def verify(self, fnames):
+        keys = [self._key(fname) for fname in fnames]
+        cached = [self._cached(fname, key) for fname, key in zip(fnames, keys)]
+        todo = [fname for fname, c in zip(fnames, cached) if not c]
+        results = self._results(todo)
+
+        for fname, key, c in zip(fnames, keys, cached):
+            path = os.path.abspath(fname)
+            records = None
+            if c:
+                self.hits += 1
+            else:
+                valid, nrec, records = next(results)
+                self.files[path] = dict(key, valid=valid, records=nrec)
+            entry = self.files[path]
+            yield fname, entry['valid'], entry['records'], records
+        self.save()
+
+    # _verify_file of each of fnames, in order. The pool only runs a few
+    # files ahead, as their valid records are held until they are used.
+    def _results(self, fnames):
+        if self.pool is None:
+            for fname in fnames:
+                yield _verify_file(fname, self.wave)
+            return
+        pending = deque()
+        for fname in fnames:
+            pending.append(self.pool.apply_async(_verify_file, (fname,)))
+            if len(pending) > 2 * self.jobs:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def save(self):
+        if self.manifest:
+            tmp = self.manifest + '.tmp'
+            with open(tmp, 'w') as fd:
+                json.dump({'files': self.files}, fd)
+            os.replace(tmp, self.manifest)
+
+    def close(self):
+        self.save()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+# read and decode all .bin files (and HDF5 session files) in the directory,
+# dir can also be a single file. The records are verified by verifier (by
+# default one process, no manifest). If sink is given the valid records of
+# each file are passed to it instead of being returned.
+def readdir(dir, lfp, verbose=0, osr=4, wave=None, verifier=None, sink=None):
     if wave is None:
         wave = ADSBwave(osr=osr, verbose=verbose, lfp=lfp)
+    if verifier is None:
+        verifier = FileVerifier(osr, wave=wave)
         
     fsize = 0
 
@@ -177,58 +303,64 @@ def readdir(dir, lfp, verbose=0, osr=4, wave=None):
     failed = 0
     dataset = []
     print(f"Exploring Directory: {dir}:", file=lfp)
-    dirfiles = os.listdir(dir)
+    if os.path.isfile(dir):
+        dir, dirfiles = os.path.dirname(dir), [os.path.basename(dir)]
+    else:
+        dirfiles = os.listdir(dir)
     #dirfiles.sort(key=lambda f: int(re.sub('\D', '', f)))
     dirfiles_sorted = sorted(dirfiles)
     # Set to positive integer for debugging.
     ftrunc = 0
 
+    fnames = []
     for filename in dirfiles_sorted:
-        if ftrunc > 0 and fcount > ftrunc:
+        if ftrunc > 0 and len(fnames) > ftrunc:
             break
-        if filename.endswith(".bin"):            
-            fcount += 1            
-            fname = (os.path.join(dir, filename))
-            fsize += os.path.getsize(fname)
-            with open(fname, 'rb') as f:
-                data = pickle.load(f)
-                if verbose > 1:
-                    print(f"file({fcount}): {fname} {len(data)} {len(dataset)}", file=lfp)
-                fstr = f"file({fcount}): {fname} {len(data)} {len(dataset)}"
-                valid_data = []
-                for x in data:
-                    (dtime, d_in, d_out) = x
-                    if verbose > 0:
-                        print(dtime, file=lfp)
-                    v = wave.verify(d_in, d_out)
-                    if v:
-                        verified += 1
-                        valid_data.append((dtime, d_in, d_out))
-                    else:
-                        failed += 1
-                        
-                    try:
-                        #pms.tell(d_out)
-                        if verbose > 0:
-                            mytell(d_out, lfp)
-                        pass    
-                    except:
-                        #import pdb; pdb.set_trace()
-                        pass
-                        
-                    if verbose > 0:
-                        print(file=lfp)
-                    
-                    print(f"\r{fstr} - Verified: {verified}, Failed: {failed}        ", end='')
+        fname = (os.path.join(dir, filename))
+        if filename.endswith(".bin") or (filename.endswith(".h5") and is_h5_tdata(fname)):
+            fnames.append(fname)
+
+    for fname, valid, nrec, valid_data in verifier.verify(fnames):
+        fcount += 1            
+        fsize += os.path.getsize(fname)
+        fstr = f"file({fcount}): {fname} {nrec} {verified}"
+        if verbose > 1:
+            print(fstr, file=lfp)
+        verified += len(valid)
+        failed += nrec - len(valid)
+        if len(valid) == 0 and verbose == 0:
+            print(f"\r{fstr} - Verified: {verified}, Failed: {failed}        ", end='')
+            continue
 
-                dataset = dataset + valid_data
+        # files from the manifest are loaded here, as are all the records
+        # of each file for the verbose listing
+        if valid_data is None or verbose > 0:
+            data = load_tdata(fname)
+            valid_data = [data[k] for k in valid]
+        if verbose > 0:
+            valid_set = set(valid)
+            for k, (dtime, d_in, d_out) in enumerate(data):
+                print(dtime, file=lfp)
+                if k not in valid_set:
+                    print('Verify: failed', file=lfp)
+                try:
+                    mytell(d_out, lfp)
+                except:
+                    pass
+                print(file=lfp)
+        print(f"\r{fstr} - Verified: {verified}, Failed: {failed}        ", end='')
+
+        if sink is not None:
+            sink(valid_data)
+        else:
+            dataset.extend(valid_data)
 
     print(f"\nFound {fcount} .bin files in {dir}")
-    print(f"Total records={len(dataset)} verified={verified} failed={failed}")
+    print(f"Total records={verified} verified={verified} failed={failed}")
     print(f"Total file size {eng_string(fsize, format='%.3f', si=True)}")
 
     print(f"\nFound {fcount} .bin files in {dir}", file=lfp)
-    print(f"Total records={len(dataset)} verified={verified} failed={failed}", file=lfp)
+    print(f"Total records={verified} verified={verified} failed={failed}", file=lfp)
     print(f"Total file size {eng_string(fsize, format='%.3f', si=True)}", file=lfp, flush=True)
 
     return dataset, fcount
@@ -240,7 +372,7 @@ def dirwalk_old(rootdir, lfp, cargs):
     fcount = 0
 
     if cargs.preproc:
-        icao_to_label_map = []
+        icao_to_label_map = LabelMap()
 
     dataset = []
         
@@ -256,7 +388,7 @@ def dirwalk_old(rootdir, lfp, cargs):
                     dataset += r_dataset
                     
                 else:
-                    sei_timestamps, sei_inputs, sei_inputs_iq, sei_labels = preproc_sei_raw(lfp, cargs, r_dataset, icao_to_label_map)
+                    sei_timestamps, sei_inputs, sei_inputs_iq, sei_labels, _ = preproc_sei_raw(lfp, cargs, r_dataset, icao_to_label_map, relabel=False)
                     if sei_timestamps is not None and sei_timestamps.shape[0] > 0:
                         print(f"Samples: {len(sei_timestamps)}", file=lfp, flush=True)
                         print(f"icao_to_label_map len: {len(icao_to_label_map)}", file=lfp, flush=True)
@@ -288,7 +420,7 @@ def dirwalk_old(rootdir, lfp, cargs):
             return dataset, None, False
             
         else:
-            sei_timestamps, sei_inputs, sei_inputs_iq, sei_labels = preproc_sei_raw(lfp, cargs, r_dataset, icao_to_label_map)
+            sei_timestamps, sei_inputs, sei_inputs_iq, sei_labels, _ = preproc_sei_raw(lfp, cargs, r_dataset, icao_to_label_map, relabel=False)
             if sei_timestamps is not None and sei_timestamps.shape[0] > 0:
                 print(f"Sample len: {len(sei_timestamps)}", file=lfp, flush=True)
                 print(f"icao_to_label_map len: {len(icao_to_label_map)}", file=lfp, flush=True)
@@ -308,10 +440,15 @@ def dirwalk_old(rootdir, lfp, cargs):
 def dirwalk(rootdir, lfp, cargs):
 
     wave = ADSBwave(osr=cargs.osr, verbose=cargs.verbose, lfp=lfp)
+    verifier = FileVerifier(cargs.osr, cargs.jobs, cargs.manifest, wave)
     fcount = 0
 
-    if cargs.preproc:
-        icao_to_label_map = []
+    icao_to_label_map = LabelMap.load(cargs.labels) if cargs.preproc else None
+
+    # preprocessed aggregates are written as they are read
+    sink = None
+    if cargs.preproc and cargs.write and (not cargs.save_by_dir or cargs.agg):
+        sink = SEIWriter(cargs, cargs.oname, lfp, icao_to_label_map)
 
     dataset = []
 
@@ -320,11 +457,20 @@ def dirwalk(rootdir, lfp, cargs):
     else:
         dir_list = [rootdir]
         
-    for dirname in rootdir:
-        fcount += dir_read_and_walk(lfp, cargs, dirname, dataset, icao_to_label_map, dirname, wave)
+    for dirname in dir_list:
+        fcount += dir_read_and_walk(lfp, cargs, dirname, dataset, icao_to_label_map, dirname, wave, verifier, sink)
+    verifier.close()
+    print(f"{verifier.hits} files taken from the manifest {cargs.manifest}", file=lfp, flush=True)
 
     print(f"Total of {fcount} records read.", file=lfp, flush=True)
 
+    if sink is not None:
+        sink.close()
+    if icao_to_label_map is not None:
+        icao_to_label_map.save(cargs.labels)
+    if sink is not None:
+        return None, None, None
+
     if not cargs.save_by_dir or cargs.agg:
         if not cargs.preproc:           
             return dataset, None, False
@@ -335,27 +481,27 @@ def dirwalk(rootdir, lfp, cargs):
     else:     
         return None, None, None
    
-def dir_read_and_walk(lfp, cargs, dirname_path, dataset, icao_to_label_map, rootdir, wave):
+def dir_read_and_walk(lfp, cargs, dirname_path, dataset, icao_to_label_map, rootdir, wave, verifier=None, sink=None):
 
     r_fcount = 0
     # Descend through child directories
-    for subdirname in os.listdir(dirname_path):
+    for subdirname in (os.listdir(dirname_path) if os.path.isdir(dirname_path) else []):
         subdirname_path = f"{dirname_path}/{subdirname}"
         print(f"Checking: {dirname_path} in {subdirname}", file=lfp)
         if os.path.isdir(subdirname_path):
-            r_fcount += dir_read_and_walk(lfp, cargs, subdirname_path, dataset, icao_to_label_map, rootdir, wave)
+            r_fcount += dir_read_and_walk(lfp, cargs, subdirname_path, dataset, icao_to_label_map, rootdir, wave, verifier, sink)
     
     # Process files in this directory    
     print(f"reading from: {dirname_path}", file=lfp)
-    r_dataset, l_r_fcount = readdir(dirname_path, lfp, verbose=cargs.verbose, osr=cargs.osr, wave=wave)
+    r_dataset, l_r_fcount = readdir(dirname_path, lfp, verbose=cargs.verbose, osr=cargs.osr, wave=wave, verifier=verifier, sink=sink)
                        
     if not cargs.save_by_dir or cargs.agg:
         if not cargs.preproc:
             print(f"Appending dataset: {rootdir}", file=lfp, flush=True)
             dataset += r_dataset
             
-        else:
-            sei_timestamps, sei_inputs, sei_inputs_iq, sei_labels = preproc_sei_raw(lfp, cargs, r_dataset, icao_to_label_map)
+        elif sink is None:
+            sei_timestamps, sei_inputs, sei_inputs_iq, sei_labels, _ = preproc_sei_raw(lfp, cargs, r_dataset, icao_to_label_map, relabel=False)
             if sei_timestamps is not None and sei_timestamps.shape[0] > 0:
                 print(f"Samples: {len(sei_timestamps)}", file=lfp, flush=True)
                 print(f"icao_to_label_map len: {len(icao_to_label_map)}", file=lfp, flush=True)
@@ -365,7 +511,7 @@ def dir_read_and_walk(lfp, cargs, dirname_path, dataset, icao_to_label_map, root
                 
     elif len(r_dataset) > 0:
         fname = f"{cargs.oname}_{dirname_path.replace(rootdir,'')}.{cargs.otype}"
-        writedata(cargs, fname, lfp, r_dataset)  
+        writedata(cargs, fname, lfp, r_dataset, icao_to_label_map)  
         
         # Force GC
         r_dataset = None
@@ -376,154 +522,295 @@ def dir_read_and_walk(lfp, cargs, dirname_path, dataset, icao_to_label_map, root
         
     return fcount
 
+class LabelMap(object):
+    """ICAO address to label registry: the addresses in label order, as the
+    icao_to_label_map lists always were, with a dict from address to label
+    so a lookup does not search the list. It reads like a list (len, [],
+    iteration, in) but addresses are only added with append or label, which
+    keep the two in step. It can be loaded from and saved to a JSON file
+    (--labels) so the labels stay the same across runs."""
+
+    def __init__(self, icaos=()):
+        super(LabelMap, self).__init__()
+        self._icaos = []
+        self.labels = {}
+        for icao in icaos:
+            self.append(icao)
+
+    def __len__(self):
+        return len(self._icaos)
+
+    def __getitem__(self, label):
+        return self._icaos[label]
+
+    def __iter__(self):
+        return iter(self._icaos)
+
+    def __contains__(self, icao):
+        return icao in self.labels
+
+    def __repr__(self):
+        return f"LabelMap({self._icaos!r})"
+
+    def index(self, icao):
+        try:
+            return self.labels[icao]
+        except KeyError:
+            raise ValueError(f"{icao} is not in the label map")
+
+    def append(self, icao):
+        if icao in self.labels:
+            raise ValueError(f"{icao} is already in the label map")
+        self.labels[icao] = len(self._icaos)
+        self._icaos.append(icao)
+
+    # label of icao, added with the next label if new
+    def label(self, icao, lfp=None):
+        sei_label = self.labels.get(icao)
+        if sei_label is None:
+            sei_label = len(self)
+            if lfp is not None:
+                print(f"Adding new icao_addr: {icao} as id: {sei_label} to icao_to_label_map", file=lfp, flush=True)
+            self.append(icao)
+        return sei_label
+
+    @classmethod
+    def load(cls, fname):
+        if fname and os.path.isfile(fname):
+            with open(fname) as fd:
+                return cls(json.load(fd))
+        return cls()
+
+    def save(self, fname):
+        if fname:
+            tmp = fname + '.tmp'
+            with open(tmp, 'w') as fd:
+                json.dump(self._icaos, fd)
+            os.replace(tmp, fname)
+
 def get_class_stats(arr):
     class_stats = {}
     class_stats['values'], class_stats['counts'] = np.unique(arr, return_counts=True)
     
     return class_stats
 
-def filter_classes(cargs, lfp, sei_labels, sei_inputs, sei_inputs_iq, sei_timestamps, icao_to_label_map):
+# Removes the samples of the classes with fewer than class_sample_thresh
+# samples. With relabel the classes kept are renumbered 0..n-1 in label
+# order and the returned map only holds their addresses, otherwise the
+# labels and map are left as they are (e.g. those of a --labels registry).
+def filter_classes(cargs, lfp, sei_labels, sei_inputs, sei_inputs_iq, sei_timestamps, icao_to_label_map, relabel=True):
 
-    class_stats = get_class_stats(sei_labels)
-    csv, csc = class_stats['values'], class_stats['counts']
-    inc_labels_idxs = []
-    for c_id in range(csc.shape[0]):
-        if csc[c_id] >= cargs.class_sample_thresh:
-            inc_labels_idxs.extend(np.where(sei_labels == csv[c_id])[0].tolist())
+    values, inverse, counts = np.unique(sei_labels, return_inverse=True, return_counts=True)
+    keep_class = counts >= cargs.class_sample_thresh
+    keep = keep_class[inverse]
 
-    inc_labels_count = len(inc_labels_idxs)
-    print(f"found {inc_labels_count} classes with sample count >= {cargs.class_sample_thresh} out of {csc.shape[0]} original classes.", file=lfp, flush=True)
-    if inc_labels_count > 0:
-        print(f"maximum sample count = {csc.max()}.", file=lfp, flush=True)
-    
-    #if inc_labels_count > 1:
-    #    inc_labels_idxs = np.concatenate(inc_labels)
-    #elif inc_labels_count == 1:
-    #    inc_labels_idxs = inc_labels
-    #else:
-    if inc_labels_count < 1:
+    print(f"found {keep_class.sum()} classes with sample count >= {cargs.class_sample_thresh} out of {len(values)} original classes.", file=lfp, flush=True)
+    if len(counts) > 0:
+        print(f"maximum sample count = {counts.max()}.", file=lfp, flush=True)
+
+    if not keep_class.any():
         print(f"WARNING: No classes found with sample count >= {cargs.class_sample_thresh}", file=lfp, flush=True)
-        #exit(2)
         return None, None, None, None, None, None
-    
-    r_sei_labels = sei_labels[inc_labels_idxs]
-    r_sei_inputs = sei_inputs[inc_labels_idxs]
-    r_sei_inputs_iq = sei_inputs_iq[inc_labels_idxs]
-    r_sei_timestamps = sei_timestamps[inc_labels_idxs]
-    samples_num = r_sei_labels.shape[0]
-
-    # Regenerate labels
-    new_unique_labels = np.unique(sei_labels)
-    sei_label_num = new_unique_labels.shape[0]
-    new_icao_to_label_map = []
-    for new_lbl, old_lbl in enumerate(new_unique_labels):
-        sei_labels[sei_labels==old_lbl] = new_lbl
-        new_icao_to_label_map.append(icao_to_label_map[old_lbl])
-
-    # Regenerate Class stats
-    class_stats = get_class_stats(r_sei_labels)
-    assert class_stats['counts'].sum() == samples_num
-
-    return r_sei_labels , r_sei_inputs, r_sei_inputs_iq, r_sei_timestamps, new_icao_to_label_map, samples_num
-        
-def preproc_sei_raw(lfp, cargs, dataset, icao_to_label_map):
+
+    if relabel:
+        new_ids = (np.cumsum(keep_class) - 1).astype(sei_labels.dtype)
+        r_sei_labels = new_ids[inverse][keep]
+        new_icao_to_label_map = LabelMap(icao_to_label_map[old_lbl] for old_lbl in values[keep_class])
+    else:
+        r_sei_labels = sei_labels[keep]
+        new_icao_to_label_map = icao_to_label_map
+
+    return r_sei_labels, sei_inputs[keep], sei_inputs_iq[keep], sei_timestamps[keep], new_icao_to_label_map, len(r_sei_labels)
+
+# number of samples of the preamble kept for SEI
+def preamble_samples(cargs):
+    return int(cargs.preamble_time * cargs.raw_sample_rate * cargs.over_sample)
+
+# Returns the SEI arrays (timestamps, inputs, inputs_iq, labels) of the
+# records of dataset that have an ICAO address, as float64 seconds, float32,
+# complex64 and int32. New addresses are added to icao_to_label_map (a
+# LabelMap) and the downlink formats are counted in df_stats. A progress bar
+# is shown if desc is given.
+def sei_arrays(cargs, lfp, dataset, icao_to_label_map, df_stats, desc=None):
+    psn = preamble_samples(cargs)
+
+    keep = []
+    labels = []
+    for k, (dtime, d_in, d_out) in enumerate(tqdm(dataset, desc=desc) if desc else dataset):
+        # Get unique ID part of ADBS code
+        icao_addr, df_val = adsb_dec.get_icao(d_out)
+        df_stats[df_val] = df_stats.get(df_val, 0) + 1
+        if icao_addr is None:
+            continue
+
+        keep.append(k)
+        labels.append(icao_to_label_map.label(icao_addr, lfp))
+
+    sei_inputs_iq = np.zeros((len(keep), psn), dtype=np.complex64)
+    for i, k in enumerate(keep):
+        sei_inputs_iq[i] = np.asarray(dataset[k][1])[0:psn]
+    sei_timestamps = timestamps_ns([dataset[k][0] for k in keep]) / 1e9
+
+    # Convert to Real and Imaginary parts else use Magnitude and phase
+    if cargs.real_im:
+        sei_inputs = np.concatenate((sei_inputs_iq.real, sei_inputs_iq.imag), axis=1)
+    else:
+        sei_inputs = np.concatenate((np.abs(sei_inputs_iq), np.angle(sei_inputs_iq)), axis=1)
+
+    return sei_timestamps, sei_inputs.astype(np.float32), sei_inputs_iq, np.array(labels, dtype=np.int32)
+
+def preproc_sei_raw(lfp, cargs, dataset, icao_to_label_map, relabel=True):
     ''' Preprocess Raw SEI data which is in the form of a list of  tuples (dtime, d_in, d_out)
     where:
         dtime is the timestamp
         d_in is a numpy array of complex
         dount is a hexidecimal stream
+    Returns the SEI arrays and the label map of their labels (icao_to_label_map
+    unless classes were filtered out with relabel, see filter_classes).
     '''
 
     samples_num = len(dataset)
 
     # SEI Input is real pairs as the real part and the magnitde of the complex part.
     # Only first preamble samples are used
-
-    sample_rate = cargs.raw_sample_rate * cargs.over_sample
-    preamble_sample_num = int(cargs.preamble_time * sample_rate)
-    psn = preamble_sample_num
-    in_size = int(psn*2)
+    preamble_sample_num = preamble_samples(cargs)
 
     if samples_num < 1:
         print(f"No data found for preprocessing!", file=lfp, flush=True)
-        #sei_inputs_iq = np.ndarray((samples_num, psn)).astype(np.complex128)        
-        #sei_inputs = np.ndarray((samples_num, in_size)).astype(np.float64)        
-        #sei_timestamps = np.ndarray((samples_num, psn)).astype(np.float64)        
-        #sei_labels = np.zeros((samples_num)).astype(np.int32)
-
-        return None, None, None, None
+        return None, None, None, None, icao_to_label_map
 
     print(f"Preprocessing Raw Input data with preamble_sample_num: {preamble_sample_num}", file=lfp, flush=True)
     print(f"Raw Input data len: {samples_num}, and raw input type is: {type(dataset[0])} of length {len(dataset[0])}", file=lfp, flush=True)
-    
+
     # Acquire samples and labels (also provide raw I/Q samples)
-    sei_inputs_iq = np.ndarray((samples_num, psn)).astype(np.complex128)        
-    sei_inputs = np.ndarray((samples_num, in_size)).astype(np.float64)        
-    sei_timestamps = np.ndarray((samples_num)).astype(np.float64)        
-    sei_labels = np.zeros((samples_num)).astype(np.int32)
-    
-    # Accummuate Unique Ids
-    #icao_to_label_map = []
-    icao_to_label_num = len(icao_to_label_map)
-    samples_with_icao = 0
-    np_julian_zero = np.datetime64('1970-01-01T00:00:00')
-    np_1sec = np.timedelta64(1, 's')
     df_stats = {}
-    
-    for dtuple in tqdm(dataset, desc="Extract from RAW SEI"):
-        dtime, d_in, d_out = dtuple
-        
-        # Get unique ID part of ADBS code
-        icao_addr, df_val = adsb_dec.get_icao(d_out)
-        if df_val in df_stats:
-            df_stats[df_val] += 1
-        else:
-            df_stats[df_val] = 1
-            
-        if icao_addr is None:
-            continue
-            
-        try:
-            sei_label = icao_to_label_map.index(icao_addr)
-            
-        except ValueError:
-            print(f"Adding new icao_addr: {icao_addr} as id: {icao_to_label_num} to icao_to_label_map", file=lfp, flush=True)
-            icao_to_label_map.append(icao_addr)
-            icao_to_label_num += 1
-            sei_label = icao_to_label_map.index(icao_addr)
-             
-        sei_labels[samples_with_icao] = sei_label
-        np_d_in = np.array(d_in)
-        # Convert to Real and Imaginary parts else use Magnitude and phase
-        if cargs.real_im:
-            sei_inputs[samples_with_icao] = np.concatenate((np.real(np_d_in[0:psn]),np.imag(np_d_in[0:psn])))
-        else:  
-            sei_inputs[samples_with_icao] = np.concatenate((np.abs(np_d_in[0:psn]),np.angle(np_d_in[0:psn])))
-
-        sei_inputs_iq[samples_with_icao] = np_d_in[0:psn]
-        sei_timestamps[samples_with_icao] = (np.datetime64(dtime) - np_julian_zero) / np_1sec
-        samples_with_icao += 1
+    sei_timestamps, sei_inputs, sei_inputs_iq, sei_labels = sei_arrays(cargs, lfp, dataset, icao_to_label_map, df_stats, "Extract from RAW SEI")
+    samples_num = len(sei_labels)
 
     print(f"DF stats.", file=lfp, flush=True)
     for k in df_stats.keys():
         print(f"   {k}: {df_stats[k]}", file=lfp, flush=True)
-    
-    # truncate dataset to those with valid callsign_to_label_map
-    print(f"Got {samples_with_icao} samples with valid icao and {icao_to_label_num} distinct icaos.", file=lfp, flush=True)
-    sei_inputs = sei_inputs[:samples_with_icao,:]
-    sei_inputs_iq = sei_inputs_iq[:samples_with_icao,:]
-    sei_timestamps = sei_timestamps[:samples_with_icao]
-    sei_labels = sei_labels[:samples_with_icao]
-    samples_num = samples_with_icao
 
-    sei_label_num = icao_to_label_num
+    print(f"Got {samples_num} samples with valid icao and {len(icao_to_label_map)} distinct icaos.", file=lfp, flush=True)
 
     # Now filter out classes with insufficient samples if requested
     if cargs.class_sample_thresh > 0:
-        sei_labels, sei_inputs, sei_inputs_iq, sei_timestamps, icao_to_label_map, samples_num = filter_classes(cargs, lfp, sei_labels, sei_inputs, sei_inputs_iq, sei_timestamps, icao_to_label_map)
+        sei_labels, sei_inputs, sei_inputs_iq, sei_timestamps, icao_to_label_map, samples_num = filter_classes(cargs, lfp, sei_labels, sei_inputs, sei_inputs_iq, sei_timestamps, icao_to_label_map, relabel)
                 
-    return sei_timestamps, sei_inputs, sei_inputs_iq, sei_labels
+    return sei_timestamps, sei_inputs, sei_inputs_iq, sei_labels, icao_to_label_map
     
+
+class SEIWriter(object):
+    """preprocesses records as they are read and appends the SEI samples to
+    resizable, chunked HDF5 datasets, so only one chunk of records is in
+    memory at a time whatever the size of the corpus. Classes with fewer
+    than class_sample_thresh samples over the whole file are removed when
+    it is closed (and the others renumbered unless the labels come from a
+    --labels registry)."""
+
+    def __init__(self, cargs, fname, lfp, icao_to_label_map=None, chunk=4096):
+        super(SEIWriter, self).__init__()
+        if ".h5" not in fname:
+            print(f"Forcing data type to H5!", file=lfp, flush=True)
+            print(f"Forcing data type to H5!", flush=True)
+            fname += '.h5'
+        self.cargs = cargs
+        self.fname = fname
+        self.lfp = lfp
+        self.chunk = chunk
+        self.limit = cargs.trunc
+        self.icao_to_label_map = LabelMap() if icao_to_label_map is None else icao_to_label_map
+        self.df_stats = {}
+        self.samples_num = 0
+
+        psn = preamble_samples(cargs)
+        Path(fname).resolve().parent.mkdir(parents=True, exist_ok=True)
+        self.h5 = h5py.File(fname, 'w')
+        for name, width, dtype in [('sei_timestamps', None, np.float64), ('sei_inputs', 2 * psn, np.float32),
+                                   ('sei_inputs_iq', psn, np.complex64), ('sei_labels', None, np.int32)]:
+            shape = (0,) if width is None else (0, width)
+            self.h5.create_dataset(name, shape=shape, maxshape=(None,) + shape[1:], dtype=dtype,
+                                   chunks=(256,) + shape[1:])
+        print(f"Saving preprocessed data to: {fname}.", file=lfp, flush=True)
+
+    # preprocesses the records of dataset (tuples (dtime, d_in, d_out)) and
+    # appends their samples
+    def __call__(self, dataset):
+        for lo in range(0, len(dataset), self.chunk):
+            if self.limit is not None and self.samples_num >= self.limit:
+                return
+            arrays = sei_arrays(self.cargs, self.lfp, dataset[lo:lo + self.chunk], self.icao_to_label_map, self.df_stats)
+            n = len(arrays[3])
+            if self.limit is not None:
+                n = min(n, self.limit - self.samples_num)
+            for name, data in zip(['sei_timestamps', 'sei_inputs', 'sei_inputs_iq', 'sei_labels'], arrays):
+                ds = self.h5[name]
+                ds.resize(self.samples_num + n, axis=0)
+                ds[self.samples_num:] = data[:n]
+            self.samples_num += n
+
+    # removes the samples of the classes with fewer than thresh samples,
+    # moving the samples kept forward one chunk at a time, and returns the
+    # label map of the labels written
+    def _filter_classes(self, thresh, relabel):
+        sei_labels = self.h5['sei_labels'][:]
+        values, inverse, counts = np.unique(sei_labels, return_inverse=True, return_counts=True)
+        keep_class = counts >= thresh
+        keep = keep_class[inverse]
+        print(f"found {keep_class.sum()} classes with sample count >= {thresh} out of {len(values)} original classes.", file=self.lfp, flush=True)
+        if not keep.any():
+            print(f"WARNING: No classes found with sample count >= {thresh}", file=self.lfp, flush=True)
+        for name in ['sei_timestamps', 'sei_inputs', 'sei_inputs_iq']:
+            ds = self.h5[name]
+            w = 0
+            for lo in range(0, self.samples_num, self.chunk):
+                rows = ds[lo:lo + self.chunk][keep[lo:lo + self.chunk]]
+                ds[w:w + len(rows)] = rows
+                w += len(rows)
+            ds.resize(w, axis=0)
+
+        icao_to_label_map = self.icao_to_label_map
+        if relabel:
+            sei_labels = (np.cumsum(keep_class) - 1).astype(np.int32)[inverse]
+            icao_to_label_map = LabelMap(icao_to_label_map[old_lbl] for old_lbl in values[keep_class])
+        self.h5['sei_labels'].resize(int(keep.sum()), axis=0)
+        self.h5['sei_labels'][:] = sei_labels[keep]
+        self.samples_num = int(keep.sum())
+        return icao_to_label_map
+
+    def close(self):
+        SEIdata_version = '1.0'
+        lfp = self.lfp
+        print(f"DF stats.", file=lfp, flush=True)
+        for k in self.df_stats.keys():
+            print(f"   {k}: {self.df_stats[k]}", file=lfp, flush=True)
+        print(f"Got {self.samples_num} samples with valid icao and {len(self.icao_to_label_map)} distinct icaos.", file=lfp, flush=True)
+
+        icao_to_label_map = self.icao_to_label_map
+        if self.cargs.class_sample_thresh > 0 and self.samples_num > 0:
+            icao_to_label_map = self._filter_classes(self.cargs.class_sample_thresh, self.cargs.labels is None)
+
+        if self.samples_num == 0:
+            self.h5.close()
+            os.remove(self.fname)
+            print(f"No valid samples found for saving!", file=lfp, flush=True)
+            print(f"No valid samples found for saving!", flush=True)
+            return
+
+        print(f"ICAO Stats", file=lfp, flush=True)
+        cnts = np.bincount(self.h5['sei_labels'][:], minlength=len(icao_to_label_map))
+        for icao_label in np.flatnonzero(cnts):
+            print(f"{icao_label}: {icao_to_label_map[icao_label]}, samples: {cnts[icao_label]}.", file=lfp, flush=True)
+
+        self.h5.create_dataset('icao_to_label_map', data=list(icao_to_label_map))
+        self.h5.attrs['SEIData_version'] = SEIdata_version
+        self.h5.close()
+        print(f"Saved preprocessed data of {self.samples_num} samples to: {self.fname}.", flush=True)
+
+        fsize = os.path.getsize(self.fname)
+        print(f"Wrote training file of size {eng_string(fsize, format='%.3f', si=True)} to {self.fname}.", file=lfp, flush=True)
+        print(f"Wrote training file of size {eng_string(fsize, format='%.3f', si=True)} to {self.fname}.", flush=True)
+
 # write dataset to a file starting from unpreprocessed data 
 def writedata(cargs, fname, lfp, dataset, icao_to_label_map_in=None, preproced=False):
     SEIdata_version = '1.0'
@@ -535,6 +822,10 @@ def writedata(cargs, fname, lfp, dataset, icao_to_label_map_in=None, preproced=F
         tstr = " truncated"
         s_dset = dataset[:cargs.trunc]
 
+    # Ensure the parent directory exists
+    parent = Path(fname).resolve().parent
+    parent.mkdir(parents=True, exist_ok=True)
+
     if cargs.preproc:
 
         if preproced:
@@ -559,17 +850,17 @@ def writedata(cargs, fname, lfp, dataset, icao_to_label_map_in=None, preproced=F
                 sei_inputs_iq = np.concatenate(in_iq_lst)
                 sei_labels = np.concatenate(lbls_lst)
         else:
-            icao_to_label_map = []
-            sei_timestamps, sei_inputs, sei_inputs_iq, sei_labels = preproc_sei_raw(lfp, cargs, s_dset, icao_to_label_map)
+            icao_to_label_map = LabelMap() if icao_to_label_map_in is None else icao_to_label_map_in
+            sei_timestamps, sei_inputs, sei_inputs_iq, sei_labels, icao_to_label_map = preproc_sei_raw(lfp, cargs, s_dset, icao_to_label_map, cargs.labels is None)
 
-        samples_num = sei_timestamps.shape[0] 
+        samples_num = 0 if sei_timestamps is None else sei_timestamps.shape[0]
 
-        print(f"ICAO Stats", file=lfp, flush=True)
-        icao_labels, cnts = np.unique(sei_labels, return_counts=True)
-        for icao_label, cnt in zip(icao_labels, cnts):
-            print(f"{icao_label}: {icao_to_label_map[icao_label]}, samples: {cnt}.", file=lfp, flush=True)
-            
         if samples_num > 0:
+            print(f"ICAO Stats", file=lfp, flush=True)
+            icao_labels, cnts = np.unique(sei_labels, return_counts=True)
+            for icao_label, cnt in zip(icao_labels, cnts):
+                print(f"{icao_label}: {icao_to_label_map[icao_label]}, samples: {cnt}.", file=lfp, flush=True)
+
             print(f"Saving preprocessed data of {samples_num} samples to: {fname}.", file=lfp, flush=True)
             print(f"Saving preprocessed data of {samples_num} samples to: {fname}.", flush=True)
                 
@@ -579,21 +870,18 @@ def writedata(cargs, fname, lfp, dataset, icao_to_label_map_in=None, preproced=F
                     data_file.create_dataset('sei_inputs', data=sei_inputs)
                     data_file.create_dataset('sei_inputs_iq', data=sei_inputs_iq)
                     data_file.create_dataset('sei_labels', data=sei_labels)
-                    data_file.create_dataset('icao_to_label_map', data=icao_to_label_map)
+                    data_file.create_dataset('icao_to_label_map', data=list(icao_to_label_map))
                     data_file.attrs['SEIData_version'] = SEIdata_version
         else:
             print(f"No valid samples found for saving!", file=lfp, flush=True)
             print(f"No valid samples found for saving!", flush=True)
+            return
             
     else:
 
         print(f"Saving{tstr} data to: {fname}.", file=lfp, flush=True)
         print(f"Saving{tstr} data to: {fname}.", flush=True)
 
-        # Ensure the parent directory exists
-        parent = Path(fname).resolve().parent
-        parent.mkdir(parents=True, exist_ok=True)
-        
         if ".h5" in fname:
             with h5py.File(fname, 'w') as data_file:
                 data_file.create_dataset('timestamp', data=s_dset[0])
@@ -644,7 +932,7 @@ def writedata_old(cargs, fname, lfp, dataset, icao_to_label_map):
             data_file.create_dataset('sei_inputs', data=sei_inputs)
             data_file.create_dataset('sei_inputs_iq', data=sei_inputs_iq)
             data_file.create_dataset('sei_labels', data=sei_labels)
-            data_file.create_dataset('icao_to_label_map', data=icao_to_label_map)
+            data_file.create_dataset('icao_to_label_map', data=list(icao_to_label_map))
 
         
     else:
@@ -662,7 +950,7 @@ if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', action='count', default=0, help='Verbose mode')
-    parser.add_argument('-d', '--dirname', nargs='+', type=str, default='.', help='Root directory wherre to find the raw adsb data files in .bin format')
+    parser.add_argument('-d', '--dirname', nargs='+', type=str, default='.', help='Root directory wherre to find the raw adsb data files in .bin format (or HDF5 files written by adsb_read.py --h5)')
     parser.add_argument('--osr', action='store', type=int, default=4, help='Over-Sampling Rate')
     parser.add_argument('--trunc', action='store', type=int, default=None, help='Truncate the output to create a shiorter file for debugging')
 
@@ -678,6 +966,9 @@ if __name__ == "__main__":
     parser.add_argument('--over_sample', type=int, action='store', default=4, help='Over sample rate')
     parser.add_argument('--preamble_time', type=float, action='store', default=8e-6, help='Preamble time (duration)')
     parser.add_argument('--class_sample_thresh', type=int, action='store', default=0, help='Minimum number of sample instances to be included in preprocessed dataset.')
+    parser.add_argument('-j', '--jobs', type=int, action='store', default=os.cpu_count(), help='Number of processes verifying the files')
+    parser.add_argument('--manifest', action='store', type=str, default='gentset_manifest.json', help='Cache of the verified records of each file, files not changed since are not verified again ("" for none)')
+    parser.add_argument('--labels', action='store', type=str, default=None, help='ICAO to label registry (JSON), read at the start and saved at the end so labels stay the same across runs; classes filtered out are then not renumbered')
     parser.add_argument('--real_im', action='store_true', default=False, help='Convert data to real and imaginary instead of magnitude and phase.')
 
     cargs = parser.parse_args()